@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+
+# Convert a whole corpus of MusicXML scores with a pool of processes.
+# Input :
+#       - a directory : for the "midi" mode, each sub-directory is a piece and its score
+#           files, sorted by name, are the parts of the quartet (Vn1, Vn2, Va, Vc).
+#           For the "data" mode, every score file found in the directory is converted
+#           (with --out, to the same path relative to the output directory).
+#       - or a manifest : a text file with one job per line, paths separated by tabs.
+#           "midi" mode : the xml paths of the quartet, optionally followed by the save path
+#           (without _all.mid, as for xmlToMidi). "data" mode : one xml path, optionally
+#           followed by the .npz save path. Empty lines and lines starting with # are skipped.
+#
+# Every job is seeded from its output name (trills are randomized), so that a score is
+# converted the same way whatever the number of workers. A failing job does not stop the
+# batch : its traceback is reported. Jobs writing the same output are rejected before
+# any is run. Outputs are written to a temporary file which is renamed once complete.
+# With --cache, the score statistics computed before the pianoroll pass are kept on disk
+# (see scoreCache), so that converting a corpus again parses each score only once.
+#
+# Usage :
+#       python -m musicxml_parser.batchConvert midi path/to/corpus --out path/to/midi --workers 64
+
+import argparse
+import json
+import os
+import sys
+import traceback
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from .xmlToData import xmlToData
+from .xmlToMidi import xmlToMidiBytes
+from .scoreCache import ScoreStatsCache
+from .fileUtils import atomic_save
+
+score_extensions = ('.xml', '.musicxml', '.mxl')
+
+
+def job_seed(save_path, seed=0):
+    return (zlib.crc32(os.path.basename(save_path).encode('utf8')) + seed) % 2**32
+
+
+def list_scores(directory):
+    return sorted(os.path.join(directory, name) for name in os.listdir(directory)
+                  if name.lower().endswith(score_extensions))
+
+
+def read_manifest(manifest_path):
+    jobs = []
+    with open(manifest_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                jobs.append([path.strip() for path in line.split('\t')])
+    return jobs
+
+
+def check_outputs(jobs):
+    # Two jobs writing the same file would overwrite each other
+    seen = set()
+    duplicates = []
+    for job in jobs:
+        save_path = os.path.normpath(job[1])
+        if save_path in seen:
+            duplicates.append(job[1])
+        seen.add(save_path)
+    if duplicates:
+        raise ValueError('several jobs write {}'.format(', '.join(sorted(set(duplicates)))))
+    return jobs
+
+
+def find_quartets(source, out_dir=None, insts=4):
+    """List the (xml_paths, save_path) jobs of the midi mode
+
+    """
+    quartets = []
+    if os.path.isdir(source):
+        for name in sorted(os.listdir(source)):
+            piece_dir = os.path.join(source, name)
+            if not os.path.isdir(piece_dir):
+                continue
+            xml_paths = list_scores(piece_dir)
+            if xml_paths:
+                save_path = os.path.join(out_dir if out_dir else piece_dir, name)
+                quartets.append((xml_paths, save_path))
+    else:
+        for paths in read_manifest(source):
+            xml_paths, save_path = paths[:insts], (paths[insts] if len(paths) > insts else None)
+            if save_path is None:
+                save_path = os.path.splitext(xml_paths[0])[0]
+                if out_dir:
+                    save_path = os.path.join(out_dir, os.path.basename(save_path))
+            quartets.append((xml_paths, save_path))
+    return check_outputs(quartets)
+
+
+def find_scores(source, out_dir=None):
+    """List the (xml_path, save_path) jobs of the data mode
+
+    With out_dir, the scores of a directory keep their path relative to it under out_dir.
+    """
+    scores = []
+    if os.path.isdir(source):
+        for root, _, files in sorted(os.walk(source)):
+            for xml_path in list_scores(root):
+                save_path = None
+                if out_dir:
+                    save_path = os.path.join(out_dir, os.path.splitext(os.path.relpath(xml_path, source))[0] + '.npz')
+                scores.append((xml_path, save_path))
+    else:
+        for paths in read_manifest(source):
+            scores.append((paths[0], paths[1] if len(paths) > 1 else None))
+
+    jobs = []
+    for xml_path, save_path in scores:
+        if save_path is None:
+            save_path = os.path.splitext(xml_path)[0] + '.npz'
+            if out_dir:
+                save_path = os.path.join(out_dir, os.path.basename(save_path))
+        jobs.append((xml_path, save_path))
+    return check_outputs(jobs)
+
+
+def _convert_quartet(job):
+    xml_paths, save_path, quantization, programs, seed, cache = job
+    save_path = "{}_all.mid".format(save_path)
+    try:
+        np.random.seed(job_seed(save_path, seed))
+        mid = xmlToMidiBytes(xml_paths, quantization, programs, cache)
+
+        def write_midi(path):
+            with open(path, 'wb') as f:
+                f.write(mid)
+        atomic_save(save_path, write_midi)
+        error = None
+    except Exception:
+        error = traceback.format_exc()
+    return {'inputs': list(xml_paths), 'output': save_path, 'error': error}
+
+
+def _convert_score(job):
+    xml_path, save_path, quantization, seed, cache = job
+    try:
+        np.random.seed(job_seed(save_path, seed))
+        roll, art, dyn = xmlToData(xml_path, quantization, cache)
+        atomic_save(save_path, lambda path: np.savez(path, roll=roll, art=art, dyn=dyn))
+        error = None
+    except Exception:
+        error = traceback.format_exc()
+    return {'inputs': [xml_path], 'output': save_path, 'error': error}
+
+
+def run_jobs(function, jobs, workers=None):
+    # Results are returned in the order of the jobs
+    if workers == 1:
+        return [function(job) for job in jobs]
+    results = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(function, job) for job in jobs]
+        for job, future in zip(jobs, futures):
+            try:
+                results.append(future.result())
+            except Exception:
+                # The worker itself died (BrokenProcessPool...)
+                results.append({'inputs': job[0] if isinstance(job[0], list) else [job[0]],
+                                'output': job[1], 'error': traceback.format_exc()})
+    return results
+
+
+def batchXmlToMidi(quartets, quantization=96, programs=[40,40,40,40,41,41,42,42], workers=None, seed=0, cache=None):
+    """Run xmlToMidi on a list of (xml_paths, save_path) quartets, see find_quartets
+
+    """
+    jobs = [(list(xml_paths), save_path, quantization, programs, seed, cache) for xml_paths, save_path in quartets]
+    return run_jobs(_convert_quartet, jobs, workers)
+
+
+def batchXmlToData(scores, quantization=96, workers=None, seed=0, cache=None):
+    """Run xmlToData on a list of (xml_path, save_path) and save roll, art and dyn in a .npz
+
+    """
+    jobs = [(xml_path, save_path, quantization, seed, cache) for xml_path, save_path in scores]
+    return run_jobs(_convert_score, jobs, workers)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Convert MusicXML scores in parallel')
+    parser.add_argument('mode', choices=['midi', 'data'], help='quartets to midi, or each score to a .npz')
+    parser.add_argument('source', help='directory or manifest file')
+    parser.add_argument('--out', default=None, help='output directory (default : next to the scores)')
+    parser.add_argument('--quantization', type=int, default=96)
+    parser.add_argument('--workers', type=int, default=None, help='default : number of cpus')
+    parser.add_argument('--insts', type=int, default=4, help='parts per line of a midi manifest')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--cache', default=None, help='directory of the score statistics cache')
+    parser.add_argument('--cache-size', type=int, default=64, help='maximum size of the cache in MB')
+    parser.add_argument('--report', default=None, help='write the per-file results to this json file')
+    args = parser.parse_args(argv)
+    cache = ScoreStatsCache(args.cache, args.cache_size * 2**20) if args.cache else None
+
+    if args.mode == 'midi':
+        results = batchXmlToMidi(find_quartets(args.source, args.out, args.insts),
+                                 args.quantization, workers=args.workers, seed=args.seed, cache=cache)
+    else:
+        results = batchXmlToData(find_scores(args.source, args.out),
+                                 args.quantization, workers=args.workers, seed=args.seed, cache=cache)
+
+    failed = [result for result in results if result['error'] is not None]
+    for result in failed:
+        print('FAILED {}\n{}'.format(' '.join(result['inputs']), result['error']))
+    print('{} converted, {} failed'.format(len(results) - len(failed), len(failed)))
+
+    if args.report is not None:
+        def write_report(path):
+            with open(path, 'w', encoding='utf-8') as f:
+                json.dump(results, f, indent=2)
+        atomic_save(args.report, write_report)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+
+# Frame-rate curves from MIDI control changes (e.g. the CC11 expression of the rolls).
+# Between two control changes, the curve is linearly interpolated when their values
+# differ by at most max_step (smoothed ramps written by reverse_pianoroll), and held
+# at the first value otherwise (jumps). After the last control change, the curve
+# stays at its value.
+
+import numpy as np
+import pretty_midi
+
+# Time far after the end of any piece, closing the last segment
+end_of_curve = 1e16
+
+
+def control_curve(control_changes, n_frames, number=11, frame_rate=250, initial=80, max_step=2):
+    """Value of the controller number at each of the n_frames frames
+
+    control_changes : pretty_midi.ControlChange list, sorted by time.
+    initial : value at frame 0, unless a control change happens there.
+    """
+    curve = {0: initial}
+    value = initial
+    for cc in control_changes:
+        if cc.number == number:
+            value = cc.value
+            curve[cc.time*frame_rate] = value
+    curve[end_of_curve] = value
+
+    times = np.array(sorted(curve.keys()), dtype=np.float64)
+    values = np.array([curve[time] for time in sorted(curve.keys())], dtype=np.float64)
+
+    frames = np.arange(n_frames)
+    # Segment [times[k], times[k+1]) of each frame
+    k = np.searchsorted(times, frames, side='right') - 1
+    k0, k1 = times[k], times[k+1]
+    v0, v1 = values[k], values[k+1]
+    w0 = (k1-frames) / (k1-k0)
+    w1 = (frames-k0) / (k1-k0)
+    return np.where(np.abs(v0-v1) <= max_step, w0*v0+w1*v1, v0)
+
+
+def midi_control_curve(midi_path, n_frames, number=11, frame_rate=250, initial=80, max_step=2):
+    # control_curve of the first instrument of a MIDI file
+    mid = pretty_midi.PrettyMIDI(midi_path)
+    return control_curve(mid.instruments[0].control_changes, n_frames, number, frame_rate, initial, max_step)
@@ -0,0 +1,30 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+
+# Files written completely or not at all : the outputs of batchConvert and synthToAudio
+# are written to a temporary file, renamed to their path once complete, so that an
+# interrupted job leaves no partial output that would be taken for a finished one.
+
+import os
+import tempfile
+
+
+def atomic_save(save_path, write):
+    """Call write(path) on a temporary file next to save_path, then rename it to save_path
+
+    """
+    directory = os.path.dirname(save_path) or '.'
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp', suffix=os.path.splitext(save_path)[1])
+    os.close(fd)
+    try:
+        write(tmp_path)
+        # mkstemp creates the file readable by its owner only
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(tmp_path, 0o666 & ~umask)
+        os.replace(tmp_path, save_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
@@ -1,15 +1,62 @@
-from midiToSynth import midiToSynth
-from synthToAudio import synthToAudio
+from .midiToSynth import batchMidiToSynth, part_instrument, sort_by_length
+from .synthToAudio import synthToAudio, default_save_path
+from .synthScheduler import run_tasks, valid_synth, valid_audio
 
-def generate_synth(path_format, save_format, splits, insts=4):
+# client : a synthServer.SynthClient, to run the synthesis in a server which keeps
+# the weights loaded, instead of loading them in this process
+# store : save the synthesis parameters as entries of a synthStore.SynthStore, save_format
+# giving "{store directory}/{key}" (e.g. "piece/synth/{:02d}_{:01d}"), and path_format
+# of generate_audio_from_synth the same entries
+# workers : number of worker processes (see synthScheduler), threads : tensorflow
+# threads of each worker, manifest_path : json file recording the state of every job
+# The jobs whose outputs already exist are skipped, so an interrupted build can be
+# started again with the same arguments.
+
+def generate_synth(path_format, save_format, splits, insts=4, batch_size=8, client=None, store=False,
+                   workers=1, threads=None, manifest_path=None):
+    jobs = []
+    skipped = []
     for split_num in range(splits):
         for inst_num in range(insts):
-            midiToSynth(path_format.format(split_num, inst_num, "roll"),
-                        path_format.format(split_num, inst_num, "art"),
-                        save_path=save_format.format(split_num, inst_num))
-            
-def generate_audio_from_synth(path_format, splits, interpolation_rate=0.99, insts=4):
+            job = (path_format.format(split_num, inst_num, "roll"),
+                   path_format.format(split_num, inst_num, "art"),
+                   save_format.format(split_num, inst_num))
+            if valid_synth(job[2], store):
+                skipped.append(job[2])
+            else:
+                jobs.append(job)
+    # Splits of the same instrument are synthesized together
+    if client is not None:
+        client.batchMidiToSynth(jobs, batch_size, store)
+        return
+
+    by_instrument = {}
+    for job in jobs:
+        by_instrument.setdefault(part_instrument(job[0]), []).append(job)
+    tasks = []
+    for instrument_jobs in by_instrument.values():
+        # Files of the same length are batched by the synthesis generator : sorted, they
+        # end up in the same tasks
+        instrument_jobs = sort_by_length(instrument_jobs)
+        for i in range(0, len(instrument_jobs), batch_size):
+            batch = instrument_jobs[i:i+batch_size]
+            tasks.append(([job[2] for job in batch], batchMidiToSynth, (batch, batch_size, store), {}))
+    run_tasks(tasks, workers, threads, manifest_path, skipped)
+
+def generate_audio_from_synth(path_format, splits, interpolation_rate=0.99, insts=4, client=None,
+                              chunk_frames=None, workers=1, threads=None, manifest_path=None):
+    synth = synthToAudio if client is None else client.synthToAudio
+    tasks = []
+    skipped = []
     for split_num in range(splits):
         for inst_num in range(insts):
-            synthToAudio(path_format.format(split_num, inst_num),
-                         interpolation_rate=interpolation_rate)
\ No newline at end of file
+            synth_path = path_format.format(split_num, inst_num)
+            if valid_audio(default_save_path(synth_path)):
+                skipped.append(synth_path)
+            elif client is not None:
+                synth(synth_path, interpolation_rate=interpolation_rate, chunk_frames=chunk_frames)
+            else:
+                tasks.append(([synth_path], synthToAudio, (synth_path,),
+                              {'interpolation_rate': interpolation_rate, 'chunk_frames': chunk_frames}))
+    if client is None:
+        run_tasks(tasks, workers, threads, manifest_path, skipped)
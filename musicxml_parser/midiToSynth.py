@@ -1,74 +1,152 @@
-from midi_ddsp import load_pretrained_model
-from midi_ddsp.utils.midi_synthesis_utils import synthesize_mono_midi
-from midi_ddsp.utils.inference_utils import get_process_group
 import numpy as np
-import pretty_midi
 import os
+import pretty_midi
+from .pretrainedModel import get_models
+from .controlCurve import midi_control_curve
+from .synthStore import SynthStore
 
-synthesis_generator, expression_generator = load_pretrained_model()
+part_to_inst_dict = {0:0, 1:0, 2:1, 3:2}
 
-def midiToSynth(roll_path, art_path, interpolation_rate=0.99, save_path=None):
+def part_instrument(roll_path):
+    # ".../{split}_{part}_roll.mid"
     part_num = int(roll_path.split("/")[-1][-10])
-    part_to_inst_dict = {0:0, 1:0, 2:1, 3:2}
-    instrument_id = part_to_inst_dict[part_num]
-    midi_audio, midi_control_params, midi_synth_params, conditioning_df = \
-        synthesize_mono_midi(synthesis_generator, expression_generator,
-                            roll_path, instrument_id, output_dir=None, 
-                            pitch_offset=0, speed_rate=1)
-
-    f0_ori = midi_synth_params['f0_hz']
-    amps_ori = midi_synth_params['amplitudes'].numpy()[0,...,0]
-    noise_ori = midi_synth_params['noise_magnitudes'].numpy()
-    hd_ori = midi_synth_params['harmonic_distribution']
-
-    midi_audio2, midi_control_params2, midi_synth_params2, conditioning_df2 = \
-        synthesize_mono_midi(synthesis_generator, expression_generator,
-                            art_path, instrument_id, output_dir=None, 
-                            pitch_offset=0, speed_rate=1)
-
-    amps_new = midi_synth_params2['amplitudes'].numpy()[0,...,0]
-    noise_new = midi_synth_params2['noise_magnitudes'].numpy()
+    return part_to_inst_dict[part_num]
 
-    new_length = min(amps_ori.shape[0], amps_new.shape[0])
+def midi_length(midi_path):
+    # End of the last note, in seconds : the length of the conditioning of the file
+    midi = pretty_midi.PrettyMIDI(midi_path)
+    return max((note.end for instrument in midi.instruments for note in instrument.notes), default=0.0)
+
+def sort_by_length(jobs):
+    # (roll_path, art_path, save_path) jobs from the shortest to the longest
+    return sorted(jobs, key=lambda job: max(midi_length(job[0]), midi_length(job[1])))
+
+def conditioning_length(conditioning_df):
+    # Frames of the synthesis parameters of a conditioning
+    return conditioning_df.tail(1)['offset'].values[0]
+
+def midi_conditioning(midi_path, instrument_id):
+    # The expression generator is bidirectional over the notes : one file at a time
+    # midi_ddsp (and tensorflow) are only imported when parameters are generated
+    import tensorflow as tf
+    from midi_ddsp.utils.midi_synthesis_utils import mono_midi_to_note_sequence
+    from midi_ddsp.utils.inference_utils import expression_generator_output_to_conditioning_df
+    _, expression_generator = get_models()
+    note_sequence = mono_midi_to_note_sequence(midi_path, tf.constant([instrument_id]))
+    expression_generator_outputs = expression_generator(note_sequence, out=None, training=False)
+    return expression_generator_output_to_conditioning_df(expression_generator_outputs['output'], note_sequence)
+
+def synth_params_from_conditioning(conditioning_dfs, instrument_id):
+    """Synthesis parameters of several conditionings of one instrument and of the same
+    length, with one call of the synthesis generator
+
+    The midi decoder runs a bidirectional GRU over the frames : padding a shorter
+    conditioning (as batch_conditioning_df_to_audio of midi_ddsp does) would change its
+    parameters, so only conditionings of equal length are stacked. The parameters are
+    then the same as with one call per conditioning.
+    """
+    import tensorflow as tf
+    from midi_ddsp.utils.inference_utils import ensure_same_length, conditioning_df_to_dict, \
+        conditioning_df_to_midi_features
+    lengths = [conditioning_length(conditioning_df) for conditioning_df in conditioning_dfs]
+    if len(set(lengths)) > 1:
+        raise ValueError('conditionings of different lengths {}'.format(sorted(set(lengths))))
+    conditioning_dicts = [conditioning_df_to_dict(conditioning_df) for conditioning_df in conditioning_dfs]
+    conditioning_dict = {key: tf.concat(ensure_same_length([c[key] for c in conditioning_dicts]), 0)
+                         for key in conditioning_dicts[0].keys()}
+    midi_features_all = [conditioning_df_to_midi_features(conditioning_df) for conditioning_df in conditioning_dfs]
+    midi_features = tuple(tf.concat(ensure_same_length([m[i] for m in midi_features_all]), 0)
+                          for i in range(len(midi_features_all[0])))
+    instrument_ids = tf.constant([instrument_id] * len(conditioning_dfs))
+    synthesis_generator, _ = get_models()
+
+    if synthesis_generator.use_f0_ld:
+        _, _, synth_params = synthesis_generator.gen_audio_from_cond_dict(
+            conditioning_dict, midi_features, instrument_id=instrument_ids)
+    else:
+        # The synthesis parameters are the outputs of the decoder, no need for the audio
+        _, synth_params = synthesis_generator.midi_decoder.gen_params_from_cond(
+            conditioning_dict, midi_features, instrument_id=instrument_ids)
+
+    params = []
+    for n, length in enumerate(lengths):
+        params.append({key: synth_params[key][n:n+1, :length].numpy()
+                       for key in ('f0_hz', 'amplitudes', 'noise_magnitudes', 'harmonic_distribution')})
+    return params
 
+def expression_curve(roll_path, new_length):
     ## Dynamic
-    mid0 = pretty_midi.PrettyMIDI(roll_path)
-    expression_dict = {0:80}
-    for cc in mid0.instruments[0].control_changes:
-        if cc.number == 11:
-            val = cc.value
-            expression_dict[cc.time*250] = val
-    expression_dict[1e16] = val
-
-    expression_times = sorted(list(expression_dict.keys()))+[1e16]
-    cursor = 0
-    expression_list = []
-    for i in range(new_length):
-        while (i >= expression_times[cursor+1]):
-            cursor += 1
-        k0 = expression_times[cursor]
-        v0 = expression_dict[k0]
-        k1 = expression_times[cursor+1]
-        v1 = expression_dict[k1]
-        if np.abs(v0-v1) <= 2:
-            w0 = (k1-i) / (k1-k0)
-            w1 = (i-k0) / (k1-k0)
-            expression_list.append(w0*v0+w1*v1)
-        else:
-            expression_list.append(v0)
-
-    expression = np.array(expression_list)
+    expression = midi_control_curve(roll_path, new_length, number=11, frame_rate=250, initial=80)
     expression = (expression+1)/128
-    
+    return expression
+
+def save_synth(roll_path, roll_params, art_params, save_path=None, store=False):
+    # store : save_path is "{store directory}/{key}", an entry of a synthStore.SynthStore,
+    # instead of a .npz file
+    f0_ori = roll_params['f0_hz']
+    amps_ori = roll_params['amplitudes'][0,...,0]
+    noise_ori = roll_params['noise_magnitudes']
+    hd_ori = roll_params['harmonic_distribution']
+
+    amps_new = art_params['amplitudes'][0,...,0]
+    noise_new = art_params['noise_magnitudes']
+
+    new_length = min(amps_ori.shape[0], amps_new.shape[0])
+    expression = expression_curve(roll_path, new_length)
 
     if save_path is None:
         save_path = "{}".format(roll_path[:-9])
-    
-    np.savez(save_path+".npz", 
-             f0_ori=f0_ori, 
-             amps_ori=amps_ori,
-             noise_ori=noise_ori,
-             hd_ori=hd_ori,
-             amps_new=amps_new,
-             noise_new=noise_new,
-             expression=expression)
\ No newline at end of file
+
+    arrays = dict(f0_ori=f0_ori,
+                  amps_ori=amps_ori,
+                  noise_ori=noise_ori,
+                  hd_ori=hd_ori,
+                  amps_new=amps_new,
+                  noise_new=noise_new,
+                  expression=expression)
+    if store:
+        directory, key = os.path.split(save_path)
+        SynthStore(directory).put(key, **arrays)
+    else:
+        np.savez(save_path+".npz", **arrays)
+
+def midiToSynth(roll_path, art_path, interpolation_rate=0.99, save_path=None, store=False):
+    instrument_id = part_instrument(roll_path)
+    roll_params, = synth_params_from_conditioning([midi_conditioning(roll_path, instrument_id)], instrument_id)
+    art_params, = synth_params_from_conditioning([midi_conditioning(art_path, instrument_id)], instrument_id)
+    save_synth(roll_path, roll_params, art_params, save_path, store)
+
+def batchMidiToSynth(jobs, batch_size=8, store=False):
+    """midiToSynth on a list of (roll_path, art_path, save_path) jobs
+
+    The midi files of each instrument are grouped by conditioning length, and up to
+    2*batch_size files of the same length go through the synthesis generator at once,
+    without padding : the parameters are the same as those of midiToSynth. Jobs sorted
+    by length (sort_by_length) make larger batches.
+    """
+    by_instrument = {}
+    for job in jobs:
+        by_instrument.setdefault(part_instrument(job[0]), []).append(job)
+
+    for instrument_id, instrument_jobs in by_instrument.items():
+        # (job, 0 for the roll or 1 for the art) of each conditioning length
+        by_length = {}
+        conditioning_dfs = {}
+        for n, (roll_path, art_path, _) in enumerate(instrument_jobs):
+            for side, midi_path in enumerate((roll_path, art_path)):
+                conditioning_df = midi_conditioning(midi_path, instrument_id)
+                conditioning_dfs[n, side] = conditioning_df
+                by_length.setdefault(conditioning_length(conditioning_df), []).append((n, side))
+
+        # A job is saved once its roll and art parameters are generated
+        params = {}
+        for files in by_length.values():
+            for i in range(0, len(files), 2*batch_size):
+                batch = files[i:i+2*batch_size]
+                batch_params = synth_params_from_conditioning(
+                    [conditioning_dfs.pop(key) for key in batch], instrument_id)
+                params.update(zip(batch, batch_params))
+                for n in sorted({n for n, _ in batch}):
+                    if (n, 0) in params and (n, 1) in params:
+                        roll_path, _, save_path = instrument_jobs[n]
+                        save_synth(roll_path, params.pop((n, 0)), params.pop((n, 1)), save_path, store)
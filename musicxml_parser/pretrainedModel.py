@@ -0,0 +1,24 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+
+# Pretrained MIDI-DDSP models, shared by midiToSynth and synthToAudio.
+# The weights are loaded on first use only, once per process, so that importing a
+# module for one of its helpers does not load them.
+
+import threading
+
+_models = None
+_lock = threading.Lock()
+
+
+def get_models():
+    """(synthesis_generator, expression_generator), loaded on the first call
+
+    """
+    global _models
+    if _models is None:
+        with _lock:
+            if _models is None:
+                from midi_ddsp import load_pretrained_model
+                _models = load_pretrained_model()
+    return _models
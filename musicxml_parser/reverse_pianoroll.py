@@ -8,6 +8,7 @@ This just serves as a fun example for rough
 transcription which can be expanded on for anyone motivated.
 """
 from __future__ import division
+import struct
 import sys
 import argparse
 import numpy as np
@@ -15,6 +16,46 @@ import pretty_midi
 import librosa
 
 
+# pretty_midi defaults, used to write the MIDI bytes directly
+resolution = 220
+initial_tempo = 120.
+tick_scale = 60.0 / (initial_tempo * resolution)
+# Channels given by pretty_midi to the instruments (9 is the drum channel)
+midi_channels = [channel for channel in range(16) if channel != 9]
+
+
+def piano_roll_notes(piano_roll):
+    """Notes of a (128, frames) piano roll, as (pitch, start, end) arrays in frames
+
+    A note is a run of non zero values of a pitch. The notes are sorted by end then pitch.
+    """
+    # Work on (frames, 128) so that np.nonzero lists the events by time then pitch.
+    # pad 1 frame of zeros so we can acknowledge inital and ending events
+    active = np.pad(piano_roll.T != 0, [(1, 1), (0, 0)], 'constant')
+    # Only look at the frames that differ from the previous one
+    packed = np.packbits(active, axis=1)
+    frames = np.flatnonzero((packed[1:] != packed[:-1]).any(axis=1)) + 1
+    before = active[frames - 1]
+    after = active[frames]
+    rows, start_pitches = np.nonzero(after & ~before)
+    start_frames = frames[rows] - 1
+    rows, pitches = np.nonzero(before & ~after)
+    end_frames = frames[rows] - 1
+    # In a given pitch, the k-th onset goes with the k-th offset
+    starts = np.empty_like(start_frames)
+    starts[np.lexsort((end_frames, pitches))] = start_frames[np.lexsort((start_frames, start_pitches))]
+    return pitches, starts, end_frames
+
+
+def dynamic_changes(dynamic):
+    """Frames where the quantized dynamic changes, and its new value
+
+    """
+    dynamic = (dynamic*127.9).astype(np.int32)
+    frames = np.nonzero(np.diff(dynamic))[0] + 1
+    return frames, dynamic[frames]
+
+
 def piano_roll_to_pretty_midi(piano_rolls, dynamics=None, fs=100, programs=None):
     '''Convert a Piano Roll array into a PrettyMidi object
      with a single instrument.
@@ -36,61 +77,134 @@ def piano_roll_to_pretty_midi(piano_rolls, dynamics=None, fs=100, programs=None)
         the piano roll.
 
     '''
+    return notes_to_pretty_midi([piano_roll_notes(piano_roll) for piano_roll in piano_rolls],
+                                dynamics, fs, programs)
+
+
+def notes_to_pretty_midi(note_lists, dynamics=None, fs=100, programs=None):
+    """Same as piano_roll_to_pretty_midi, with the (pitch, start, end) arrays of the notes
+    of each instrument (see piano_roll_notes) instead of its piano roll
+
+    """
     if programs is None:
-        l = len(piano_rolls)
-        program = [0]*l
-    
+        programs = [0]*len(note_lists)
+
     if dynamics is None:
-        l = len(piano_rolls)
-        dynamics = [None]*l
+        dynamics = [None]*len(note_lists)
 
     pm = pretty_midi.PrettyMIDI()
 
-    for piano_roll, dynamic, program in zip(piano_rolls, dynamics, programs):
-        notes, frames = piano_roll.shape
+    for (pitches, starts, ends), dynamic, program in zip(note_lists, dynamics, programs):
         instrument = pretty_midi.Instrument(program=program)
 
-        # pad 1 column of zeros so we can acknowledge inital and ending events
-        piano_roll = np.pad(piano_roll, [(0, 0), (1, 1)], 'constant')
-
-        # use changes in velocities to find note on / note off events
-        velocity_changes = np.nonzero(np.diff(piano_roll).T)
+        instrument.notes = [pretty_midi.Note(velocity=80, pitch=pitch+12, start=start, end=end)
+                            for pitch, start, end in zip(pitches.tolist(), (starts/fs).tolist(), (ends/fs).tolist())]
 
         if dynamic is not None:
-            dynamic = (dynamic*127.9).astype(np.int32)
-            dynamic_changes = np.nonzero(np.diff(dynamic))
-
-        # keep track on velocities and note on times
-        prev_velocities = np.zeros(notes, dtype=int)
-        note_on_time = np.zeros(notes)
-
-        for time, note in zip(*velocity_changes):
-            # use time + 1 because of padding above
-            velocity = piano_roll[note, time + 1]
-            time = time / fs
-            if velocity > 0:
-                if prev_velocities[note] == 0:
-                    note_on_time[note] = time
-                    prev_velocities[note] = velocity
-            else:
-                pm_note = pretty_midi.Note(
-                    velocity=80,
-                    pitch=note+12,
-                    start=note_on_time[note],
-                    end=time)
-                instrument.notes.append(pm_note)
-                prev_velocities[note] = 0
-        
-        if dynamic is not None:
-            for time, in zip(*dynamic_changes):
-                dyn = dynamic[time + 1]
-                pm_dynamic = pretty_midi.ControlChange(
-                    number=11,
-                    value=dyn,
-                    time=(time+1) / fs
-                )
-                instrument.control_changes.append(pm_dynamic)
+            frames, values = dynamic_changes(dynamic)
+            instrument.control_changes = [pretty_midi.ControlChange(number=11, value=value, time=time)
+                                          for value, time in zip(values.tolist(), (frames/fs).tolist())]
 
         pm.instruments.append(instrument)
 
     return pm
+
+
+def encode_variable_ints(values):
+    """MIDI variable-length quantities of an array of ints, as (bytes, number of bytes)
+
+    bytes has 4 columns, only the first number of bytes of each row are used.
+    """
+    n_bytes = 1 + (values >= 2**7).astype(np.int64) + (values >= 2**14) + (values >= 2**21)
+    positions = np.arange(4)
+    shifts = np.maximum(7 * (n_bytes[:, None] - 1 - positions), 0)
+    encoded = (values[:, None] >> shifts) & 0x7f
+    encoded |= np.where(positions < n_bytes[:, None] - 1, 0x80, 0)
+    return encoded, n_bytes
+
+
+def seconds_to_ticks(times):
+    # PrettyMIDI.time_to_tick with a single tempo
+    return np.round(times / tick_scale).astype(np.int64)
+
+
+def track_bytes(ticks, sort_keys, status, data1, data2):
+    """MTrk chunk of channel messages given with absolute ticks (data2 < 0 : no second data byte)
+
+    Events are sorted as in PrettyMIDI.write, by tick then sort key, and the status
+    byte is omitted when it is the same as the previous one (running status).
+    """
+    order = np.lexsort((sort_keys, ticks))
+    ticks, status, data1, data2 = ticks[order], status[order], data1[order], data2[order]
+    deltas, n_deltas = encode_variable_ints(np.diff(ticks, prepend=0))
+
+    # Row of at most 4 delta bytes, status, data1, data2, written where used
+    events = np.concatenate([deltas, status[:, None], data1[:, None], data2[:, None]], axis=1)
+    used = np.zeros(events.shape, dtype=bool)
+    used[:, :4] = np.arange(4) < n_deltas[:, None]
+    used[:, 4] = status != np.concatenate([[-1], status[:-1]])
+    used[:, 5] = True
+    used[:, 6] = data2 >= 0
+    data = events[used].astype(np.uint8).tobytes()
+    # End of track, one tick after the last event
+    data += b'\x01\xff\x2f\x00'
+    return b'MTrk' + struct.pack('>L', len(data)) + data
+
+
+def piano_roll_to_midi_bytes(piano_rolls, dynamics=None, fs=100, programs=None):
+    """Same as piano_roll_to_pretty_midi(...).write, without building the pretty_midi and mido objects
+
+    Returns the content of the .mid file. Use mido.MidiFile(file=io.BytesIO(...))
+    to get mido tracks.
+    """
+    return notes_to_midi_bytes([piano_roll_notes(piano_roll) for piano_roll in piano_rolls],
+                               dynamics, fs, programs)
+
+
+def notes_to_midi_bytes(note_lists, dynamics=None, fs=100, programs=None):
+    """Same as notes_to_pretty_midi(...).write, without building the pretty_midi and mido objects
+
+    """
+    if programs is None:
+        programs = [0]*len(note_lists)
+
+    if dynamics is None:
+        dynamics = [None]*len(note_lists)
+
+    # Timing track : 120 bpm and 4/4 at tick 0
+    tempo = int(6e7/(60./(tick_scale*resolution)))
+    timing = (b'\x00\xff\x51\x03' + struct.pack('>L', tempo)[1:] +
+              b'\x00\xff\x58\x04\x04\x02\x18\x08' + b'\x01\xff\x2f\x00')
+    tracks = [b'MTrk' + struct.pack('>L', len(timing)) + timing]
+
+    for n, ((pitches, starts, ends), dynamic, program) in enumerate(zip(note_lists, dynamics, programs)):
+        channel = midi_channels[n % len(midi_channels)]
+        pitches = pitches + 12
+        if len(pitches) and pitches.max() > 127:
+            raise ValueError('MIDI note number {} out of range'.format(pitches.max()))
+        n_notes = len(pitches)
+
+        # Program change, note ons, note offs (note on with velocity 0) and control changes
+        ticks = [[0], seconds_to_ticks(starts/fs), seconds_to_ticks(ends/fs)]
+        sort_keys = [[6 * 256 * 256],
+                     10 * 256 * 256 + pitches * 256 + 80,
+                     10 * 256 * 256 + pitches * 256]
+        status = [[0xc0 | channel], np.full(2 * n_notes, 0x90 | channel)]
+        data1 = [[program], pitches, pitches]
+        data2 = [[-1], np.full(n_notes, 80), np.zeros(n_notes, dtype=np.int64)]
+
+        if dynamic is not None:
+            frames, values = dynamic_changes(dynamic)
+            if len(values) and (values.min() < 0 or values.max() > 127):
+                raise ValueError('MIDI control value out of range')
+            ticks.append(seconds_to_ticks(frames/fs))
+            sort_keys.append(8 * 256 * 256 + 11 * 256 + values)
+            status.append(np.full(len(values), 0xb0 | channel))
+            data1.append(np.full(len(values), 11))
+            data2.append(values)
+
+        tracks.append(track_bytes(*[np.concatenate(column).astype(np.int64)
+                                    for column in (ticks, sort_keys, status, data1, data2)]))
+
+    header = b'MThd' + struct.pack('>LHHH', 6, 1, len(tracks), resolution)
+    return header + b''.join(tracks)
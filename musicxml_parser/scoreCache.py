@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+
+# On-disk cache of the score statistics computed before the pianoroll pass :
+# the total length of the score and the per-tempo shortest notes.
+# Entries are keyed by the sha1 of the score file content and the quantization, so a
+# score which is converted again (other articulation settings, another run of the
+# batch converter...) is parsed only once, directly by the pianoroll handler.
+# One small json file per entry. When the cache gets bigger than max_bytes, the least
+# recently used entries (oldest modification time, refreshed on every hit) are removed.
+
+import hashlib
+import json
+import os
+import tempfile
+import numpy as np
+
+
+def read_score(source):
+    # Content of a score given as a path, a binary file object or bytes
+    if isinstance(source, (bytes, bytearray)):
+        return bytes(source)
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, 'rb') as f:
+            return f.read()
+    return source.read()
+
+
+def score_digest(content):
+    return hashlib.sha1(content).hexdigest()
+
+
+class ScoreStatsCache(object):
+    def __init__(self, directory, max_bytes=64 * 2**20):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    def entry_path(self, digest, quantization):
+        return os.path.join(self.directory, '{}_{}.json'.format(digest, quantization))
+
+    def get(self, digest, quantization):
+        """Return (total_length, shortest_notes), or None if the score is not in the cache
+
+        """
+        path = self.entry_path(digest, quantization)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        try:
+            # Most recently used
+            os.utime(path)
+        except OSError:
+            pass
+        # json keys are strings : the tempo keys are stored as a list of pairs
+        shortest_notes = {key: np.float64(value) for key, value in entry['shortest_notes']}
+        return entry['total_length'], shortest_notes
+
+    def put(self, digest, quantization, total_length, shortest_notes):
+        entry = {'total_length': total_length,
+                 'shortest_notes': [[int(key), float(value)] for key, value in shortest_notes.items()]}
+        os.makedirs(self.directory, exist_ok=True)
+        # Several processes can share the cache : write then rename
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix='.tmp', suffix='.json')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(entry, f)
+            os.replace(tmp_path, self.entry_path(digest, quantization))
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.json') or name.startswith('.tmp'):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+        size = sum(entry[1] for entry in entries)
+        for _, entry_size, name in sorted(entries):
+            if size <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+            size -= entry_size
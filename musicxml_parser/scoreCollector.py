@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+
+# Single SAX pass over a MusicXML score.
+# While the file is read, the handler :
+#       - computes the total length of the score (TotalLengthHandler)
+#       - collects the per-tempo note durations (DurationListHandler)
+#       - buffers the SAX events, so that the pianoroll handler, which needs the two
+#         previous informations from its very first note, can be run afterwards
+#         from memory instead of parsing the file again.
+
+import xml.sax
+from .totalLengthHandler import TotalLengthHandler
+from .scoreToDurationList import DurationListHandler
+from .scoreSource import parse_score
+
+# Event kinds stored in the buffer
+START_ELEMENT = 0
+END_ELEMENT = 1
+CHARACTERS = 2
+
+
+class ScoreCollectorHandler(xml.sax.ContentHandler):
+    def __init__(self, division):
+        self.CurrentElement = u""
+        self.length_handler = TotalLengthHandler()
+        self.duration_handler = DurationListHandler(division)
+        self.events = []
+
+    def startElement(self, tag, attributes):
+        self.CurrentElement = tag
+        self.length_handler.startElement(tag, attributes)
+        self.duration_handler.startElement(tag, attributes)
+        self.events.append((START_ELEMENT, tag, attributes))
+
+    def endElement(self, tag):
+        self.length_handler.endElement(tag)
+        self.duration_handler.endElement(tag)
+        self.events.append((END_ELEMENT, tag, None))
+
+    def characters(self, content):
+        self.length_handler.characters(content)
+        self.duration_handler.characters(content)
+        # Blank contents are only looked at by the pianoroll handler inside a dashes tag
+        if content.strip() or self.CurrentElement == u"dashes":
+            self.events.append((CHARACTERS, content, None))
+
+    @property
+    def total_length(self):
+        return self.length_handler.total_length
+
+    @property
+    def duration_list(self):
+        return self.duration_handler.duration_list
+
+
+def replay_events(events, handler):
+    """Feed buffered SAX events to a content handler, in the order they were read
+
+    """
+    start_element = handler.startElement
+    end_element = handler.endElement
+    characters = handler.characters
+    for kind, value, attributes in events:
+        if kind == START_ELEMENT:
+            start_element(value, attributes)
+        elif kind == END_ELEMENT:
+            end_element(value)
+        else:
+            characters(value)
+    return handler
+
+
+def collect_score(score_path, quantization):
+    # score_path can also be a binary file object or bytes, see scoreSource
+    return parse_score(score_path, ScoreCollectorHandler(quantization))
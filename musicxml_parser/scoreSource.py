@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+
+# Feed a MusicXML score to a SAX content handler.
+# The DOCTYPE of MusicXML files points to an external DTD (often a local path on the
+# computer of the publisher) that made the parser crash when it tried to load it.
+# Instead of rewriting the file without its DOCTYPE, the parser is told not to load
+# any external entity, so the score is read only once, straight from its source.
+# A source can be a path, a binary file object or the content of the file as bytes.
+#
+# Compressed MusicXML (.mxl) : the source is a zip archive. The score is the first
+# rootfile listed in META-INF/container.xml, and it is decompressed on the fly while
+# it is parsed, without being extracted.
+
+import io
+import os
+import zipfile
+import xml.sax
+import xml.sax.handler
+import xml.sax.xmlreader
+
+musicxml_media_types = ('application/vnd.recordare.musicxml+xml', 'application/vnd.recordare.musicxml')
+
+
+class IgnoreDTDResolver(xml.sax.handler.EntityResolver):
+    # Resolve every external entity to an empty document
+    def resolveEntity(self, publicId, systemId):
+        source = xml.sax.xmlreader.InputSource(systemId)
+        source.setByteStream(io.BytesIO(b''))
+        return source
+
+
+class ContainerHandler(xml.sax.ContentHandler):
+    # List the rootfiles of META-INF/container.xml
+    def __init__(self):
+        self.rootfiles = []
+
+    def startElement(self, tag, attributes):
+        if tag == u'rootfile' and u'full-path' in attributes:
+            self.rootfiles.append((attributes[u'full-path'], attributes.get(u'media-type')))
+
+
+def make_score_parser(handler):
+    parser = xml.sax.make_parser()
+    # turn off namepsaces
+    parser.setFeature(xml.sax.handler.feature_namespaces, 0)
+    # never load the DTD
+    parser.setFeature(xml.sax.handler.feature_external_ges, 0)
+    parser.setEntityResolver(IgnoreDTDResolver())
+    parser.setContentHandler(handler)
+    return parser
+
+
+def is_mxl(source):
+    if isinstance(source, (bytes, bytearray)):
+        return bytes(source[:4]) == b'PK\x03\x04'
+    if isinstance(source, (str, os.PathLike)):
+        return zipfile.is_zipfile(source)
+    if hasattr(source, 'seekable') and source.seekable():
+        position = source.tell()
+        magic = source.read(4)
+        source.seek(position)
+        return magic == b'PK\x03\x04'
+    return False
+
+
+def mxl_rootfile(archive):
+    """Name of the MusicXML score in a .mxl archive
+
+    """
+    names = archive.namelist()
+    if 'META-INF/container.xml' in names:
+        container = ContainerHandler()
+        with archive.open('META-INF/container.xml') as f:
+            make_score_parser(container).parse(f)
+        for path, media_type in container.rootfiles:
+            if media_type is None or media_type in musicxml_media_types:
+                return path
+    # No (usable) container : first xml file outside of META-INF
+    for name in names:
+        if not name.startswith('META-INF/') and name.lower().endswith(('.xml', '.musicxml')):
+            return name
+    raise NameError('No MusicXML score found in the .mxl archive')
+
+
+def parse_score(source, handler):
+    if isinstance(source, (bytes, bytearray)):
+        source = io.BytesIO(source)
+    parser = make_score_parser(handler)
+    if is_mxl(source):
+        with zipfile.ZipFile(source) as archive:
+            with archive.open(mxl_rootfile(archive)) as score:
+                parser.parse(score)
+    else:
+        parser.parse(source)
+    return handler
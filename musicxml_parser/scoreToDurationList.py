@@ -3,10 +3,9 @@
 import numpy as np
 import xml.sax
 import re
-import os
-import tempfile
 from .smooth_dynamic import smooth_dyn
 from .totalLengthHandler import TotalLengthHandler
+from .scoreSource import parse_score
 
 mapping_step_midi = {
     'C': 0,
@@ -405,6 +404,168 @@ class ScoreToPianorollHandler(xml.sax.ContentHandler):
         return
         
 
+class DurationListHandler(xml.sax.ContentHandler):
+    # Lightweight version of the handler above : only follows the time counter and the
+    # tempo marks to collect the note durations, without writing any pianoroll.
+    # The total length of the score is thus not needed, which allows to run it in the
+    # same pass as the TotalLengthHandler
+    def __init__(self, division):
+        self.CurrentElement = u""
+        self.current_tempo = 0
+
+        # Measure informations
+        self.time = 0
+        self.division_score = -1
+        self.division_pianoroll = division
+        self.beat = -1
+        self.beat_type = -1
+        self.bar_length = -1
+        self.measure_number = 0
+
+        # Current note information
+        self.pitch_set = False
+        self.step_set = False
+        self.octave_set = False
+        self.rest = False
+        self.chord = False
+        self.duration = 0
+        self.duration_set = False
+        self.grace = False
+        self.not_played_note = False
+
+        # Directions
+        self.tempo_mark_ = False
+        self.tempo_mark = True
+        self.tempo_mark_count = 0
+        # collect durations
+        self.duration_list = {0:[]}
+
+    def startElement(self, tag, attributes):
+        self.CurrentElement = tag
+
+        if tag == u"part":
+            self.time = 0
+            self.division_score = -1
+
+        if tag == u'measure':
+            self.measure_number = attributes[u'number']
+            if self.measure_number in ("0","1"):
+                self.tempo_mark_ = True
+                self.tempo_mark_count = 1
+            elif (u'implicit' in attributes) and (attributes[u'implicit'] == "yes"):
+                self.tempo_mark_ = True
+                self.tempo_mark_count = 1
+            else:
+                if self.tempo_mark_count <= 0:
+                    self.tempo_mark_ = False
+                else:
+                    self.tempo_mark_count -= 1
+
+        if tag == u'barline':
+            self.tempo_mark_ = True
+            self.tempo_mark_count = 1
+
+        if tag == u'note':
+            self.not_played_note = False
+            if u'print-object' in attributes.keys():
+                if attributes[u'print-object'] == "no":
+                    self.not_played_note = True
+        if tag == u'rest':
+            self.rest = True
+        if tag == u'chord':
+            if self.duration_set:
+                raise NameError('A chord tag should be placed before the duration tag of the current note')
+            self.time -= self.duration
+            self.chord = True
+        if tag == u'grace':
+            self.grace = True
+
+        if tag == u'direction':
+            if u'placement' in attributes.keys() and (attributes[u'placement'] == 'above') and self.tempo_mark_:
+                self.tempo_mark = True
+
+    def endElement(self, tag):
+        if tag == u'pitch':
+            if self.octave_set and self.step_set:
+                self.pitch_set = True
+            self.octave_set = False
+            self.step_set = False
+
+        if tag == u'direction':
+            self.tempo_mark = False
+
+        if tag == u"note":
+            if not self.duration_set:
+                if not self.grace:
+                    raise NameError("XML misformed, a Duration tag is missing")
+
+            note_played = not self.not_played_note
+            if (not self.rest) and note_played:
+                if not self.pitch_set:
+                    # Same early exit as the full handler : counters are not reset
+                    return
+                self.duration_list[self.current_tempo].append(self.duration)
+
+            # Increment the time counter
+            if not self.grace and note_played:
+                self.time += self.duration
+            self.pitch_set = False
+            self.duration_set = False
+            self.rest = False
+            self.grace = False
+            self.chord = False
+
+        if tag == u'backup':
+            if not self.duration_set:
+                raise NameError("XML Duration not set for a backup")
+            self.time -= self.duration
+            self.duration_set = False
+
+        if tag == u'forward':
+            if not self.duration_set:
+                raise NameError("XML Duration not set for a forward")
+            self.time += self.duration
+            self.duration_set = False
+        return
+
+    def characters(self, content):
+        if content.strip():
+            if self.CurrentElement == u"divisions":
+                self.division_score = int(content)
+                if (not self.beat == -1) and (not self.beat_type == -1):
+                    self.bar_length = int(self.division_score * self.beat * 4 / self.beat_type)
+            if self.CurrentElement == u"beats":
+                self.beat = int(content)
+            if self.CurrentElement == u"beat-type":
+                self.beat_type = int(content)
+                assert (not self.beat == -1), "beat and beat type wrong"
+                assert (not self.division_score == -1), "division non defined"
+                self.bar_length = int(self.division_score * self.beat * 4 / self.beat_type)
+
+            if self.CurrentElement == u"duration":
+                self.duration = int(content)
+                self.duration_set = True
+                if self.rest:
+                    # A lot of (bad) publisher use a semibreve rest to say "rest all the bar"
+                    if self.duration > self.bar_length:
+                        self.duration = self.bar_length
+            if self.CurrentElement == u"step":
+                self.step_set = True
+            if self.CurrentElement == u"octave":
+                self.octave_set = True
+
+            # Directions
+            if self.CurrentElement == u'words':
+                if self.tempo_mark:
+                    t_start = int(self.time * self.division_pianoroll / self.division_score)
+                    if any(c.isupper() for c in content):
+                        print(content, t_start)
+                        self.current_tempo = t_start
+                        self.duration_list[self.current_tempo] = []
+                        self.tempo_mark = False
+        return
+
+
 def search_re_list(string, expression):
     for value in expression:
         result_re = re.search(value, string, flags=re.IGNORECASE | re.UNICODE)
@@ -413,45 +574,15 @@ def search_re_list(string, expression):
     return False
 
 
-def pre_process_file(file_path):
-    """Simply consists in removing the DOCTYPE that make the xml parser crash
-    
-    """
-
-    temp_file = tempfile.NamedTemporaryFile('w', suffix='.xml', prefix='tmp', delete=False, encoding='utf-8')
-    
-    # Remove the doctype line
-    with open(file_path, 'r', encoding="utf-8") as fread:
-        for line in fread:
-            if not re.search(r'<!DOCTYPE', line):
-                temp_file.write(line)                
-    temp_file_path = temp_file.name
-    temp_file.close()
-    
-    # Return the new path
-    return temp_file_path
-
-    
 def scoreToPianorolld(score_path, quantization):
-    # Remove DOCTYPE
-    tmp_file_path = pre_process_file(score_path)
-
     # Get the total length in quarter notes of the track
-    pre_parser = xml.sax.make_parser()
-    pre_parser.setFeature(xml.sax.handler.feature_namespaces, 0)
-    Handler_length = TotalLengthHandler()
-    pre_parser.setContentHandler(Handler_length)
-    pre_parser.parse(tmp_file_path)
-    total_length = Handler_length.total_length
+    total_length = parse_score(score_path, TotalLengthHandler()).total_length
     # Float number
     total_length = int(total_length)
 
     # Now parse the file and get the pianoroll, articulation and dynamics
-    parser = xml.sax.make_parser()
-    parser.setFeature(xml.sax.handler.feature_namespaces, 0)
     Handler_score = ScoreToPianorollHandler(quantization, total_length)
-    parser.setContentHandler(Handler_score)
-    parser.parse(tmp_file_path)
+    parse_score(score_path, Handler_score)
 
     # Using Mapping, build concatenated along time and pitch pianoroll
     pianoroll = {}
@@ -461,7 +592,6 @@ def scoreToPianorolld(score_path, quantization):
     for instru_name, mat in Handler_score.articulation.items():
         articulation[instru_name] = mat
     
-    os.remove(tmp_file_path)
     return pianoroll, articulation, Handler_score
 
 if __name__ == '__main__':
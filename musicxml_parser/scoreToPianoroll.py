@@ -13,16 +13,19 @@
 #       - Pianoroll : the different instrument are mapped from the name written in part-name
 #           to a unique name. This mapping is done through regex indexed in instru_dict.
 #           This dictionary is imported through the json format.
+#       - Notes : the handler does not write dense pianorolls. Each segment it would have
+#           written in the pianoroll or the articulation is stored as one row
+#           (start, end, pitch, flags) of a note table (see note_event_dtype).
+#           Dense rolls are built afterwards with notesToPianoroll.
 #
 
 import numpy as np
 import xml.sax
 import re
-import os
-import tempfile
-import numpy as np
 from .smooth_dynamic import smooth_dyn
 from .totalLengthHandler import TotalLengthHandler
+from .scoreSource import parse_score
+from .tempoIndex import ShortestNoteIndex
 
 mapping_step_midi = {
     'C': 0,
@@ -46,6 +49,16 @@ next_step = {
 
 keysign_notes = ['F','C','G','D','A','E','B']
 
+# One row per segment written in the pianoroll or in the articulation.
+# start and end are in frames of the pianoroll, end excluded.
+note_event_dtype = np.dtype([('start', np.int32),
+                             ('end', np.int32),
+                             ('pitch', np.int16),
+                             ('flags', np.uint8)])
+# Channel flags
+ROLL = 1
+ARTICULATION = 2
+
 mapping_dyn_number = {
     # Value drawn from http://www.wikiwand.com/en/Dynamics_%28music%29
     'ppp': 0.125,
@@ -102,14 +115,14 @@ class ScoreToPianorollHandler(xml.sax.ContentHandler):
         self.slash = False
         self.discard_grace = discard_grace
 
-        # Pianoroll
+        # Notes (pianoroll and articulation)
         self.total_length = total_length
-        self.pianoroll = {}
-        self.pianoroll_local = np.zeros([self.total_length * self.division_pianoroll, self.number_pitches], dtype=np.int)
+        self.n_frames = self.total_length * self.division_pianoroll
+        self.notes = {}
+        self.notes_local = []
+        self.erasures_local = []
 
         # Stop flags
-        self.articulation = {}
-        self.articulation_local = np.zeros([self.total_length * self.division_pianoroll, self.number_pitches], dtype=np.int)
         # Tied notes (not phrasing)
         self.tie_type = None
         self.slur_type = None
@@ -149,6 +162,7 @@ class ScoreToPianorollHandler(xml.sax.ContentHandler):
         self.trill_next_step = 0
         self.trill_length = 0
         self.shortest_notes = shortest_notes
+        self.shortest_note_at = ShortestNoteIndex(shortest_notes)
 
         # tremolo
         self.tremolo = False
@@ -177,15 +191,14 @@ class ScoreToPianorollHandler(xml.sax.ContentHandler):
             # And set to zeros time information
             self.time = 0
             self.division_score = -1
-            # Initialize the pianoroll
-            # Check if this instrument has already been seen
-            self.pianoroll_local = np.zeros([self.total_length * self.division_pianoroll, self.number_pitches], dtype=np.int)
+            # Initialize the notes
+            self.notes_local = []
+            self.erasures_local = []
             # Initialize the articulations
             self.tie_type = None
             self.tying = {}  # Contains {voice -> tie_on} ?
             self.slur_type = None
             self.sluring = {}
-            self.articulation_local = np.zeros([self.total_length * self.division_pianoroll, self.number_pitches], dtype=np.int)
             # Initialize the dynamics
             self.dynamics = np.zeros([self.total_length * self.division_pianoroll], dtype=np.float) + 0.5  # Don't initialize to zero knowing if no dynamic is given
             self.dyn_flag = {}
@@ -240,9 +253,7 @@ class ScoreToPianorollHandler(xml.sax.ContentHandler):
                 if self.trill_new_step in alter_keys:
                     self.trill_new_alter = -1
             self.trill_next_step = mapping_step_midi[self.trill_new_step] + self.trill_new_octave * 12 + self.trill_new_alter
-            keys = np.array(list(self.shortest_notes.keys()))
-            tempo_key = max(sorted(keys[keys<=time_pianoroll]))
-            self.trill_length = self.shortest_notes[tempo_key] * 1/2
+            self.trill_length = self.shortest_note_at(time_pianoroll) * 1/2
             self.trill_length = int(self.trill_length * self.division_pianoroll / self.division_score)
 
         if tag == u'time-modification':
@@ -256,9 +267,7 @@ class ScoreToPianorollHandler(xml.sax.ContentHandler):
             self.dyn_flag[time_pianoroll] = 'N'
             dyn = True
         elif tag in (u"sf", u"sfz", u"fz"):
-            keys = np.array(list(self.shortest_notes.keys()))
-            tempo_key = max(sorted(keys[keys<=time_pianoroll]))
-            length = int(self.shortest_notes[tempo_key])
+            length = int(self.shortest_note_at(time_pianoroll))
             cur_dyn = self.dynamics[time_pianoroll]
             self.dynamics[time_pianoroll:time_pianoroll+length] = mapping_dyn_number[u'f']
             self.dynamics[time_pianoroll+length:time_pianoroll+2*length] = \
@@ -266,9 +275,7 @@ class ScoreToPianorollHandler(xml.sax.ContentHandler):
             self.dyn_flag[time_pianoroll] = 'N'
             dyn = True
         elif tag in (u"sffz"):
-            keys = np.array(list(self.shortest_notes.keys()))
-            tempo_key = max(sorted(keys[keys<=time_pianoroll]))
-            length = int(self.shortest_notes[tempo_key])
+            length = int(self.shortest_note_at(time_pianoroll))
             cur_dyn = self.dynamics[time_pianoroll]
             self.dynamics[time_pianoroll:time_pianoroll+length] = mapping_dyn_number[u'ff']
             self.dynamics[time_pianoroll+length:time_pianoroll+2*length] = \
@@ -276,9 +283,7 @@ class ScoreToPianorollHandler(xml.sax.ContentHandler):
             self.dyn_flag[time_pianoroll] = 'N'
             dyn = True
         elif tag == u'fp':
-            keys = np.array(list(self.shortest_notes.keys()))
-            tempo_key = max(sorted(keys[keys<=time_pianoroll]))
-            length = int(self.shortest_notes[tempo_key])
+            length = int(self.shortest_note_at(time_pianoroll))
             self.dynamics[time_pianoroll:time_pianoroll+length] = mapping_dyn_number[u'f']
             self.dynamics[time_pianoroll+length:time_pianoroll+2*length] = \
                 np.linspace(mapping_dyn_number[u'f'], mapping_dyn_number[u'p'], length)
@@ -286,9 +291,7 @@ class ScoreToPianorollHandler(xml.sax.ContentHandler):
             self.dyn_flag[time_pianoroll + 1] = 'N'
             dyn = True
         elif tag == u'ffp':
-            keys = np.array(list(self.shortest_notes.keys()))
-            tempo_key = max(sorted(keys[keys<=time_pianoroll]))
-            length = int(self.shortest_notes[tempo_key])
+            length = int(self.shortest_note_at(time_pianoroll))
             self.dynamics[time_pianoroll:time_pianoroll+length] = mapping_dyn_number[u'ff']
             self.dynamics[time_pianoroll+length:time_pianoroll+2*length] = \
                 np.linspace(mapping_dyn_number[u'ff'], mapping_dyn_number[u'p'], length)
@@ -438,23 +441,17 @@ class ScoreToPianorollHandler(xml.sax.ContentHandler):
                 start_time = int(self.time * self.division_pianoroll / self.division_score)
                 if self.grace:
                     if self.slash:
-                        keys = np.array(list(self.shortest_notes.keys()))
-                        tempo_key = max(sorted(keys[keys<=start_time]))
-                        length = int(self.shortest_notes[tempo_key] // 2)
+                        length = int(self.shortest_note_at(start_time) // 2)
                         end_time = start_time
                         # A grace note is an anticipation
                         start_time -= length
-                        self.pianoroll_local[start_time-1:end_time, :] = int(0)
-                        self.articulation_local[start_time-1:end_time, :] = int(0)
+                        self.erase_notes(start_time-1, end_time)
                     else:
-                        keys = np.array(list(self.shortest_notes.keys()))
-                        tempo_key = max(sorted(keys[keys<=start_time]))
-                        length = int(self.shortest_notes[tempo_key] // 2)
+                        length = int(self.shortest_note_at(start_time) // 2)
                         end_time = start_time
                         # A grace note is an anticipation
                         start_time -= length
-                        self.pianoroll_local[start_time-1:end_time, :] = int(0)
-                        self.articulation_local[start_time-1:end_time, :] = int(0)
+                        self.erase_notes(start_time-1, end_time)
                 else:
                     end_time = int((self.time + self.duration) * self.division_pianoroll / self.division_score)
                 # Its pitch
@@ -534,26 +531,26 @@ class ScoreToPianorollHandler(xml.sax.ContentHandler):
                         for i in range(0, len(intervals)):
                             s = intervals[i]
                             e = intervals[i+1] if i < len(intervals)-1 else s + int(self.tremolo_length)
-                            self.articulation_local[s:e-1, midi_pitch] = int(1)
+                            self.write_note(s, e-1, midi_pitch, ARTICULATION)
 
                 elif (not tie) and (self.slur_note is None) and (not staccato) and (not staccatissimo):
                     art_end_time = end_time - 1
-                    self.articulation_local[start_time:art_end_time, midi_pitch] = int(1)
+                    self.write_note(start_time, art_end_time, midi_pitch, ARTICULATION)
                 elif (self.slur_note is not None) and (not tie) and (not slur):
                     art_end_time = end_time - 1
-                    self.articulation_local[start_time:art_end_time, self.slur_note] = int(1)
+                    self.write_note(start_time, art_end_time, self.slur_note, ARTICULATION)
                 elif (self.slur_note is not None):
                     art_end_time = end_time
-                    self.articulation_local[start_time:art_end_time, self.slur_note] = int(1)
+                    self.write_note(start_time, art_end_time, self.slur_note, ARTICULATION)
                 elif staccato:
                     art_end_time = start_time + (end_time-start_time) // 2
-                    self.articulation_local[start_time:art_end_time, midi_pitch] = int(1)
+                    self.write_note(start_time, art_end_time, midi_pitch, ARTICULATION)
                 elif staccatissimo:
                     art_end_time = start_time + (end_time-start_time) // 4
-                    self.articulation_local[start_time:art_end_time, midi_pitch] = int(1)
+                    self.write_note(start_time, art_end_time, midi_pitch, ARTICULATION)
                 elif tie:
                     art_end_time = end_time
-                    self.articulation_local[start_time:art_end_time, midi_pitch] = int(1)
+                    self.write_note(start_time, art_end_time, midi_pitch, ARTICULATION)
                 
                 ########################################################################################################
                 # pianoroll  
@@ -566,9 +563,9 @@ class ScoreToPianorollHandler(xml.sax.ContentHandler):
                         s = intervals[i-1] if i > 0 else start_time
                         m = intervals[i]
                         e = intervals[i+1]
-                        self.pianoroll_local[s:m, midi_pitch] = int(1)
-                        self.pianoroll_local[m:e, self.trill_next_step] = int(1)
-                    self.pianoroll_local[e:art_end_time,midi_pitch] = int(1)
+                        self.write_note(s, m, midi_pitch, ROLL)
+                        self.write_note(m, e, self.trill_next_step, ROLL)
+                    self.write_note(e, art_end_time, midi_pitch, ROLL)
 
                 elif self.tremolo:
                     if self.tremolo_end:
@@ -581,9 +578,9 @@ class ScoreToPianorollHandler(xml.sax.ContentHandler):
                                 e = intervals[i+1] if i < len(intervals)-1 else 2*m-s
                                 if e > art_end_time:
                                     e = art_end_time
-                                self.pianoroll_local[s:m, self.tremolo_start_pitch] = int(1)
-                                self.pianoroll_local[m:e, midi_pitch] = int(1)
-                            self.pianoroll_local[e:art_end_time,midi_pitch] = int(1)
+                                self.write_note(s, m, self.tremolo_start_pitch, ROLL)
+                                self.write_note(m, e, midi_pitch, ROLL)
+                            self.write_note(e, art_end_time, midi_pitch, ROLL)
                             self.tremolo_start_time
                             self.tremolo_length
                         else:
@@ -591,7 +588,7 @@ class ScoreToPianorollHandler(xml.sax.ContentHandler):
                             for i in range(0, len(intervals)):
                                 s = intervals[i]
                                 e = intervals[i+1] if i < len(intervals)-1 else s + int(self.tremolo_length)
-                                self.pianoroll_local[s:e-1, midi_pitch] = int(1)
+                                self.write_note(s, e-1, midi_pitch, ROLL)
                         self.tremolo = False
                         self.tremolo_double = False
                         self.tremolo_length = 0
@@ -600,17 +597,17 @@ class ScoreToPianorollHandler(xml.sax.ContentHandler):
                         self.tremolo_end = False
                         
                 elif (not tie) and (not slur) and (not staccato) and (not staccatissimo):
-                    self.pianoroll_local[start_time:end_time - 1, midi_pitch] = int(1)
+                    self.write_note(start_time, end_time - 1, midi_pitch, ROLL)
                 elif staccato:
                     stop_time = start_time + (end_time-start_time) // 2
-                    self.pianoroll_local[start_time:stop_time, midi_pitch] = int(1)
+                    self.write_note(start_time, stop_time, midi_pitch, ROLL)
                 elif staccatissimo:
                     stop_time = start_time + (end_time-start_time) // 4
-                    self.pianoroll_local[start_time:stop_time, midi_pitch] = int(1)
+                    self.write_note(start_time, stop_time, midi_pitch, ROLL)
                 elif tie:
-                    self.pianoroll_local[start_time:end_time, midi_pitch] = int(1)
+                    self.write_note(start_time, end_time, midi_pitch, ROLL)
                 elif slur:
-                    self.pianoroll_local[start_time:end_time, midi_pitch] = int(1)
+                    self.write_note(start_time, end_time, midi_pitch, ROLL)
             
 
             # Increment the time counter
@@ -663,14 +660,29 @@ class ScoreToPianorollHandler(xml.sax.ContentHandler):
             horizon = 4  # in number of quarter notes
             # dynamics = smooth_dyn(self.dynamics, self.dyn_flag, self.division_pianoroll, horizon)
             dynamics = self.dynamics
-            # Apply them on the pianoroll and articulation
-            if instru in self.pianoroll.keys():
-                self.pianoroll[instru] = np.maximum(self.pianoroll[instru], np.transpose(np.multiply(np.transpose(self.pianoroll_local), 1)))
-                self.articulation[instru] = np.maximum(self.articulation[instru], np.transpose(np.multiply(np.transpose(self.articulation_local), 1)))
+            # Parts mapped to the same instrument are merged (union of their notes)
+            notes = resolve_erasures(self.notes_local, self.erasures_local)
+            if instru in self.notes.keys():
+                self.notes[instru] = np.concatenate([self.notes[instru], notes])
             else:
-                self.pianoroll[instru] = np.transpose(np.multiply(np.transpose(self.pianoroll_local), 1))
-                self.articulation[instru] = np.transpose(np.multiply(np.transpose(self.articulation_local), 1))
+                self.notes[instru] = notes
         return
+
+    def write_note(self, start, end, pitch, flags):
+        # Equivalent of writing roll[start:end, pitch] = 1 in a dense roll of n_frames,
+        # with the same slicing rules (negative or out of range bounds)
+        if not (-self.number_pitches <= pitch < self.number_pitches):
+            raise IndexError('pitch {} is out of bounds'.format(pitch))
+        start, end, _ = slice(start, end).indices(self.n_frames)
+        if start < end:
+            self.notes_local.append((start, end, pitch % self.number_pitches, flags))
+
+    def erase_notes(self, start, end):
+        # Equivalent of roll[start:end, :] = 0, for all the channels.
+        # Only the notes written before are erased, which is resolved at the end of the part
+        start, end, _ = slice(start, end).indices(self.n_frames)
+        if start < end:
+            self.erasures_local.append((start, end, len(self.notes_local)))
         
     def characters(self, content):
         # print(self.CurrentElement, self.CurrentElement == u"dashes")
@@ -796,6 +808,49 @@ class ScoreToPianorollHandler(xml.sax.ContentHandler):
         return
         
 
+def resolve_erasures(notes, erasures):
+    """Build the note table of a part from the written notes and the erased windows.
+    erasures contains (start, end, count) : the window [start, end) is erased for the
+    count first notes only.
+
+    """
+    table = np.array(notes, dtype=note_event_dtype)
+    order = np.arange(len(table))
+    for start, end, count in erasures:
+        hit = (order < count) & (table['start'] < end) & (table['end'] > start)
+        if not hit.any():
+            continue
+        # A note can be cut in a head and a tail around the erased window
+        head = hit & (table['start'] < start)
+        tail = hit & (table['end'] > end)
+        head_notes = table[head]
+        head_notes['end'] = start
+        tail_notes = table[tail]
+        tail_notes['start'] = end
+        table = np.concatenate([table[~hit], head_notes, tail_notes])
+        order = np.concatenate([order[~hit], order[head], order[tail]])
+    return table[np.argsort(order, kind='stable')]
+
+
+def notesToPianoroll(notes, n_frames, flags=ROLL, dtype=np.uint8, start=0, end=None, number_pitches=128):
+    """Materialize a dense (time, pitch) roll from a note table
+
+    Only the notes with one of the given channel flags are written, and only the frames
+    between start and end (end excluded, default to n_frames).
+
+    """
+    if end is None or end > n_frames:
+        end = n_frames
+    start = max(start, 0)
+    roll = np.zeros([max(end - start, 0), number_pitches], dtype=dtype)
+    selected = notes[((notes['flags'] & flags) != 0) & (notes['start'] < end) & (notes['end'] > start)]
+    starts = np.maximum(selected['start'], start) - start
+    ends = np.minimum(selected['end'], end) - start
+    for s, e, pitch in zip(starts, ends, selected['pitch']):
+        roll[s:e, pitch] = 1
+    return roll
+
+
 def search_re_list(string, expression):
     for value in expression:
         result_re = re.search(value, string, flags=re.IGNORECASE | re.UNICODE)
@@ -804,55 +859,27 @@ def search_re_list(string, expression):
     return False
 
 
-def pre_process_file(file_path):
-    """Simply consists in removing the DOCTYPE that make the xml parser crash
-    
-    """
-
-    temp_file = tempfile.NamedTemporaryFile('w', suffix='.xml', prefix='tmp', delete=False, encoding='utf-8')
-    
-    # Remove the doctype line
-    with open(file_path, 'r', encoding="utf-8") as fread:
-        for line in fread:
-            if not re.search(r'<!DOCTYPE', line):
-                temp_file.write(line)                
-    temp_file_path = temp_file.name
-    temp_file.close()
-    
-    # Return the new path
-    return temp_file_path
-
-    
 def scoreToPianoroll(score_path, quantization, shortest_notes):
-    # Remove DOCTYPE
-    tmp_file_path = pre_process_file(score_path)
-
     # Get the total length in quarter notes of the track
-    pre_parser = xml.sax.make_parser()
-    pre_parser.setFeature(xml.sax.handler.feature_namespaces, 0)
-    Handler_length = TotalLengthHandler()
-    pre_parser.setContentHandler(Handler_length)
-    pre_parser.parse(tmp_file_path)
-    total_length = Handler_length.total_length
+    total_length = parse_score(score_path, TotalLengthHandler()).total_length
     # Float number
     total_length = int(total_length)
 
     # Now parse the file and get the pianoroll, articulation and dynamics
-    parser = xml.sax.make_parser()
-    parser.setFeature(xml.sax.handler.feature_namespaces, 0)
     Handler_score = ScoreToPianorollHandler(quantization, total_length, shortest_notes)
-    parser.setContentHandler(Handler_score)
-    parser.parse(tmp_file_path)
+    parse_score(score_path, Handler_score)
+
+    return build_pianoroll(Handler_score)
+
 
+def build_pianoroll(Handler_score):
     # Using Mapping, build concatenated along time and pitch pianoroll
     pianoroll = {}
     articulation = {}
-    for instru_name, mat in Handler_score.pianoroll.items():
-        pianoroll[instru_name] = (mat*128).astype(int)
-    for instru_name, mat in Handler_score.articulation.items():
-        articulation[instru_name] = mat
-    
-    os.remove(tmp_file_path)
+    n_frames = Handler_score.n_frames
+    for instru_name, notes in Handler_score.notes.items():
+        pianoroll[instru_name] = notesToPianoroll(notes, n_frames, ROLL, dtype=int) * 128
+        articulation[instru_name] = notesToPianoroll(notes, n_frames, ARTICULATION, dtype=int)
     return pianoroll, articulation, Handler_score
 
 if __name__ == '__main__':
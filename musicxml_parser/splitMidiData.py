@@ -1,28 +1,33 @@
-from .split_midi import split_midi
+from .split_midi import MidiSegmenter, clean_midi, written_tempo
 import pretty_midi
-import mido
 import os
 
-def splitMidiData(path):
+def splitMidiData(path, pitch_floor=10, overlap_ratio=0.2, clean_first=False):
+    # The file is loaded once, then cut at every tempo change.
+    # clean_first : clean the notes of the whole file once, instead of each segment
     mid = pretty_midi.PrettyMIDI(path)
-    times, tempos = mid.get_tempo_changes()
-    end_time = mid.get_end_time()
+    if clean_first:
+        clean_midi(mid, pitch_floor, overlap_ratio)
+    segmenter = MidiSegmenter(mid, not clean_first, pitch_floor, overlap_ratio)
+    times, tempos = segmenter.tempo_times, segmenter.tempi
+    end_time = segmenter.length
 
     directory = path[:-4]
     if not os.path.exists(directory):
         os.makedirs(directory)
-    
+
     times = list(times) + [end_time]
     for i in range(len(times)-1):
-        mid_split, save_path = split_midi(path, i, times[i], times[i+1], export=True)
-        midi_data = mido.MidiFile(filename=save_path) 
+        mid_split = segmenter.segment(times[i], times[i+1])
+        mid_split.write("{}/{:02d}.mid".format(path[:-4], i))
+        # Tempo of the segment, as read back from its file
+        tempo = written_tempo(mid_split._tick_scales[0][1], mid_split.resolution)
 
         for n, inst in enumerate(mid_split.instruments):
-            pm = pretty_midi.PrettyMIDI()
-            pm._load_tempo_changes(midi_data)
+            pm = pretty_midi.PrettyMIDI(initial_tempo=6e7/tempo)
             pm.instruments.append(inst)
-            
+
             if n%2 == 0:
                 pm.write("{}/{:02d}_{:01d}_roll.mid".format(path[:-4], i, n//2))
             else:
-                pm.write("{}/{:02d}_{:01d}_art.mid".format(path[:-4], i, n//2))
\ No newline at end of file
+                pm.write("{}/{:02d}_{:01d}_art.mid".format(path[:-4], i, n//2))
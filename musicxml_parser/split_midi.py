@@ -1,51 +1,151 @@
 import pretty_midi
+import bisect
 import copy
 import mido
+import numpy as np
 
 def length(midi_path):
     mid = pretty_midi.PrettyMIDI(midi_path)
-    mid2 = copy.deepcopy(mid)
-    length = mid2.get_end_time()
+    length = mid.get_end_time()
     return length
 
-def split_midi(base, split_num, start_time, end_time, export=True):
-    mid = pretty_midi.PrettyMIDI(base)
-    mid2 = copy.deepcopy(mid)
-    length = mid2.get_end_time()
-    if start_time > length:
-        raise Exception("start time exceeds length")
-    if end_time > length:
-        end_time = length
-    
-    mid2.adjust_times([start_time, end_time], [0,length])
-    mid2.adjust_times([0,length], [0,end_time-start_time])
-    
-    num_inst = len(mid2.instruments)
-    
-    for N in range(num_inst):
-        notes = mid2.instruments[N].notes
-        del_idx = []
-        for idx, note in enumerate(notes):
-            if note.pitch < 10:
-                del_idx.append(idx)
-        for index in sorted(del_idx, reverse=True):
-            del notes[index]
-            
-    for N in range(num_inst):
-        notes = mid2.instruments[N].notes
-        del_idx = []
-        end_max = 0
-        for idx, note in enumerate(notes):
-            if note.start < end_max - (note.end - note.start) * 0.2:
-                del_idx.append(idx)
-            if note.end > end_max:
-                end_max = note.end
-        for index in sorted(del_idx, reverse=True):
-            del notes[index] 
-            
+def clean_notes(notes, pitch_floor=10, overlap_ratio=0.2):
+    """Remove in place the notes below pitch_floor, then the notes starting before the
+    latest end of the previous notes minus overlap_ratio of their own duration
+
+    None disables a filter. The list is rebuilt once, in its original order.
+    """
+    if pitch_floor is not None:
+        pitches = np.array([note.pitch for note in notes], dtype=np.int64)
+        notes[:] = [note for note, keep in zip(notes, (pitches >= pitch_floor).tolist()) if keep]
+
+    if overlap_ratio is not None and notes:
+        starts = np.array([note.start for note in notes], dtype=np.float64)
+        ends = np.array([note.end for note in notes], dtype=np.float64)
+        # Latest end of the notes before each note (dropped ones included)
+        end_max = np.maximum.accumulate(np.concatenate([[0.], ends[:-1]]))
+        keep = ~(starts < end_max - (ends - starts) * overlap_ratio)
+        notes[:] = [note for note, kept in zip(notes, keep.tolist()) if kept]
+
+def clean_midi(mid, pitch_floor=10, overlap_ratio=0.2):
+    # clean_notes on every instrument of a PrettyMIDI object
+    for instrument in mid.instruments:
+        clean_notes(instrument.notes, pitch_floor, overlap_ratio)
+    return mid
+
+def written_tempo(tick_scale, resolution):
+    # Tempo in microseconds per quarter note, as stored by PrettyMIDI.write
+    return int(6e7/(60./(tick_scale*resolution)))
+
+def set_tempo_changes(pm, times, tempi):
+    # Same tick scales as the ones PrettyMIDI.adjust_times computes for these tempo changes
+    if times[0] == 0:
+        last_tick, last_tick_scale = 0, 60.0/(tempi[0]*pm.resolution)
+        times, tempi = times[1:], tempi[1:]
+    else:
+        last_tick, last_tick_scale = 0, 60.0/(120.0*pm.resolution)
+    pm._tick_scales = [(last_tick, last_tick_scale)]
+    previous_time = 0.
+    for time, tempo in zip(times, tempi):
+        tick = last_tick + (time - previous_time)/last_tick_scale
+        tick_scale = 60.0/(tempo*pm.resolution)
+        if tick_scale != last_tick_scale:
+            pm._tick_scales.append((int(round(tick)), tick_scale))
+            previous_time = time
+            last_tick, last_tick_scale = tick, tick_scale
+    pm._update_tick_to_time(pm._tick_scales[-1][0] + 1)
+
+class MidiSegmenter(object):
+    """Cut a PrettyMIDI object loaded once into time segments
+
+    The events of each instrument are sorted once by time, then the events of a
+    segment are found by binary search. A segment keeps the notes starting and ending
+    inside it, the control changes and pitch bends inside it and the last one before
+    it (moved to its start), and the same for the time signatures, all shifted to start
+    at 0, as adjust_times did.
+    The notes of each segment go through clean_notes, unless clean is False.
+    """
+    def __init__(self, mid, clean=True, pitch_floor=10, overlap_ratio=0.2):
+        self.mid = mid
+        self.clean = clean
+        self.pitch_floor = pitch_floor
+        self.overlap_ratio = overlap_ratio
+        self.length = mid.get_end_time()
+        self.tempo_times, self.tempi = mid.get_tempo_changes()
+        self.instruments = []
+        for instrument in mid.instruments:
+            note_order = sorted(range(len(instrument.notes)), key=lambda n: instrument.notes[n].start)
+            note_starts = [instrument.notes[n].start for n in note_order]
+            control_changes = sorted(instrument.control_changes, key=lambda e: e.time)
+            pitch_bends = sorted(instrument.pitch_bends, key=lambda e: e.time)
+            self.instruments.append((instrument, note_order, note_starts,
+                                     control_changes, [e.time for e in control_changes],
+                                     pitch_bends, [e.time for e in pitch_bends]))
+        signatures = sorted(mid.time_signature_changes, key=lambda e: e.time)
+        self.signatures = signatures
+        self.signature_times = [e.time for e in signatures]
+
+    @staticmethod
+    def events_in(events, times, start_time, end_time):
+        # Last event at or before start_time, then the events strictly inside
+        first = bisect.bisect_right(times, start_time)
+        last = bisect.bisect_left(times, end_time, first)
+        selected = []
+        if first > 0:
+            event = copy.copy(events[first - 1])
+            event.time = 0.
+            selected.append(event)
+        for event in events[first:last]:
+            event = copy.copy(event)
+            event.time = event.time - start_time
+            selected.append(event)
+        return selected
+
+    def segment(self, start_time, end_time):
+        if start_time > self.length:
+            raise Exception("start time exceeds length")
+        if end_time > self.length:
+            end_time = self.length
+
+        # Tempo at start_time, and its changes inside the segment
+        first = max(bisect.bisect_right(self.tempo_times, start_time) - 1, 0)
+        last = bisect.bisect_left(self.tempo_times, end_time, first + 1)
+        times = [0.] + [time - start_time for time in self.tempo_times[first + 1:last]]
+        segment = pretty_midi.PrettyMIDI(resolution=self.mid.resolution)
+        set_tempo_changes(segment, times, list(self.tempi[first:last]))
+
+        # Time signature at start_time, and its changes inside the segment
+        segment.time_signature_changes = self.events_in(self.signatures, self.signature_times,
+                                                        start_time, end_time)
+
+        for (instrument, note_order, note_starts, control_changes, control_times,
+             pitch_bends, bend_times) in self.instruments:
+            new_instrument = pretty_midi.Instrument(program=instrument.program,
+                                                    is_drum=instrument.is_drum, name=instrument.name)
+            # Notes starting in [start_time, end_time], kept in their original order
+            candidates = note_order[bisect.bisect_left(note_starts, start_time):
+                                    bisect.bisect_right(note_starts, end_time)]
+            for n in sorted(candidates):
+                note = instrument.notes[n]
+                if note.end <= end_time and note.end > note.start:
+                    new_instrument.notes.append(pretty_midi.Note(
+                        velocity=note.velocity, pitch=note.pitch,
+                        start=note.start - start_time, end=note.end - start_time))
+            new_instrument.control_changes = self.events_in(control_changes, control_times,
+                                                            start_time, end_time)
+            new_instrument.pitch_bends = self.events_in(pitch_bends, bend_times,
+                                                        start_time, end_time)
+            if self.clean:
+                clean_notes(new_instrument.notes, self.pitch_floor, self.overlap_ratio)
+            segment.instruments.append(new_instrument)
+        return segment
+
+def split_midi(base, split_num, start_time, end_time, export=True, pitch_floor=10, overlap_ratio=0.2):
+    mid2 = MidiSegmenter(pretty_midi.PrettyMIDI(base), True, pitch_floor, overlap_ratio).segment(start_time, end_time)
+
     if export:
         save_path = "{}/{:02d}.mid".format(base[:-4], split_num)
         mid2.write(save_path)
         return mid2, save_path
-    
-    return mid2
\ No newline at end of file
+
+    return mid2
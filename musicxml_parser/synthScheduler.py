@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+
+# Runs the jobs of a dataset build (synthesis parameters, audio) in a pool of worker
+# processes. Each worker pins the number of tensorflow threads, so that the workers
+# share the cores instead of all using them. The state of every job is written to a
+# json progress manifest as the jobs end; the outputs of finished jobs are checked by
+# the callers, which skip them, so a crashed build is resumed where it stopped.
+
+import json
+import multiprocessing
+import os
+import tempfile
+import time
+import traceback
+import numpy as np
+import soundfile as sf
+
+synth_arrays = ('f0_ori', 'amps_ori', 'noise_ori', 'hd_ori', 'amps_new', 'noise_new', 'expression')
+
+
+def valid_synth(save_path, store=False):
+    # Synthesis parameters of save_path (as given to save_synth) completely written
+    try:
+        if store:
+            from .synthStore import SynthStore
+            directory, key = os.path.split(save_path)
+            synth_store = SynthStore(directory)
+            return key in synth_store and all(
+                os.path.exists(synth_store.array_path(key, name)) for name in synth_arrays)
+        with np.load(save_path + ".npz") as data:
+            return all(name in data.files for name in synth_arrays)
+    except Exception:
+        return False
+
+
+def valid_audio(wav_path):
+    # synthToAudio renames the WAV into place once complete, so any WAV found is whole
+    try:
+        return sf.info(wav_path).frames > 0
+    except Exception:
+        return False
+
+
+def pin_threads(intra_op_threads, inter_op_threads):
+    # Before tensorflow starts its thread pools in the worker
+    os.environ['OMP_NUM_THREADS'] = str(intra_op_threads)
+    import tensorflow as tf
+    try:
+        tf.config.threading.set_intra_op_parallelism_threads(intra_op_threads)
+        tf.config.threading.set_inter_op_parallelism_threads(inter_op_threads)
+    except RuntimeError:
+        # tensorflow already running in this process, with its own threads
+        pass
+
+
+def run_task(task):
+    names, function, args, kwargs = task
+    start = time.time()
+    try:
+        function(*args, **kwargs)
+        error = None
+    except Exception:
+        error = traceback.format_exc()
+    return names, error, time.time() - start
+
+
+class ProgressManifest(object):
+    """State of the jobs of a build, kept in a json file : {job: {"status", "seconds", ...}}
+
+    """
+    def __init__(self, path=None):
+        self.path = path
+        self.jobs = {}
+        if path is not None and os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                self.jobs = json.load(f)
+
+    def record(self, names, status, **info):
+        for name in names:
+            self.jobs[name] = dict(status=status, **info)
+        self.write()
+
+    def write(self):
+        if self.path is None:
+            return
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp', suffix='.json')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(self.jobs, f, indent=1, sort_keys=True)
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+
+def run_tasks(tasks, workers=1, threads=None, manifest_path=None, skipped=()):
+    """Run (job names, function, args, kwargs) tasks, in workers processes if workers > 1
+
+    threads : tensorflow intra-op threads per worker, by default the cores divided
+        between the workers.
+    skipped : names of the jobs whose outputs already exist, recorded as such.
+    A failed task does not stop the others; RuntimeError is raised at the end if any
+    failed, with their tracebacks in the manifest.
+    """
+    manifest = ProgressManifest(manifest_path)
+    if skipped:
+        manifest.record(skipped, 'done', skipped=True)
+    manifest.record([name for names, _, _, _ in tasks for name in names], 'pending')
+
+    if workers > 1:
+        if threads is None:
+            threads = max(1, (os.cpu_count() or 1) // workers)
+        # tensorflow is not fork-safe
+        context = multiprocessing.get_context('spawn')
+        pool = context.Pool(workers, initializer=pin_threads, initargs=(threads, 1))
+        results = pool.imap_unordered(run_task, tasks)
+    else:
+        pool = None
+        if threads is not None:
+            pin_threads(threads, 1)
+        results = map(run_task, tasks)
+
+    failed = []
+    try:
+        for names, error, seconds in results:
+            if error is None:
+                manifest.record(names, 'done', seconds=round(seconds, 3))
+            else:
+                manifest.record(names, 'failed', seconds=round(seconds, 3), error=error)
+                failed.extend(names)
+    except BaseException:
+        if pool is not None:
+            pool.terminate()
+        raise
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    if failed:
+        raise RuntimeError('{} jobs failed : {}'.format(len(failed), ', '.join(failed)))
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+
+# Long-lived synthesis worker.
+# The server loads the MIDI-DDSP weights once and keeps them in memory, then runs
+# midiToSynth, batchMidiToSynth, synthToAudio and synthSweep for its clients over a Unix socket.
+# Several clients can be connected, their requests are run one at a time.
+#
+# Usage :
+#       python -m musicxml_parser.synthServer /tmp/synth.sock
+#   then, from any process :
+#       with SynthClient('/tmp/synth.sock') as client:
+#           client.batchMidiToSynth(jobs)
+
+import argparse
+import os
+import sys
+import threading
+import traceback
+from multiprocessing.connection import Listener, Client
+
+served_functions = ('midiToSynth', 'batchMidiToSynth', 'synthToAudio', 'synthSweep')
+
+
+def serve(address, authkey=None):
+    from .pretrainedModel import get_models
+    from .midiToSynth import midiToSynth, batchMidiToSynth
+    from .synthToAudio import synthToAudio, synthSweep
+    functions = {'midiToSynth': midiToSynth,
+                 'batchMidiToSynth': batchMidiToSynth,
+                 'synthToAudio': synthToAudio,
+                 'synthSweep': synthSweep}
+    get_models()
+
+    if os.path.exists(address):
+        # Socket left by a previous server
+        os.remove(address)
+    listener = Listener(address, family='AF_UNIX', authkey=authkey)
+    # The models are not shared between concurrent calls
+    model_lock = threading.Lock()
+    stop = threading.Event()
+
+    def handle(conn):
+        with conn:
+            while True:
+                try:
+                    name, args, kwargs = conn.recv()
+                except EOFError:
+                    return
+                if name == 'shutdown':
+                    stop.set()
+                    conn.send(('ok', None))
+                    # Wake up the accept() of the main thread
+                    Client(address, family='AF_UNIX', authkey=authkey).close()
+                    return
+                try:
+                    with model_lock:
+                        result = ('ok', functions[name](*args, **kwargs))
+                except Exception:
+                    result = ('error', traceback.format_exc())
+                conn.send(result)
+
+    try:
+        while True:
+            conn = listener.accept()
+            if stop.is_set():
+                conn.close()
+                break
+            threading.Thread(target=handle, args=(conn,), daemon=True).start()
+    finally:
+        listener.close()
+        if os.path.exists(address):
+            os.remove(address)
+
+
+class SynthClient(object):
+    def __init__(self, address, authkey=None):
+        self.conn = Client(address, family='AF_UNIX', authkey=authkey)
+
+    def call(self, name, *args, **kwargs):
+        self.conn.send((name, args, kwargs))
+        status, value = self.conn.recv()
+        if status == 'error':
+            raise RuntimeError('Synthesis server error\n{}'.format(value))
+        return value
+
+    def __getattr__(self, name):
+        if name in served_functions:
+            return lambda *args, **kwargs: self.call(name, *args, **kwargs)
+        raise AttributeError(name)
+
+    def shutdown(self):
+        self.call('shutdown')
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Serve MIDI-DDSP synthesis with resident weights')
+    parser.add_argument('socket', help='path of the Unix socket')
+    args = parser.parse_args(argv)
+    serve(args.socket)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+
+# Store of synthesis parameters, an alternative to one .npz file per split/instrument.
+# A store is a directory holding one uncompressed .npy file per array of each entry
+# ("{key}.{name}.npy") and a manifest.json listing the entries with the shapes and
+# dtypes of their arrays. The arrays are opened with mmap_mode='r', so slicing them
+# only reads the frames used. A whole piece (all its splits and instruments) is one
+# store, opened by reading its manifest once.
+#
+# An entry is addressed by the path "{store directory}/{key}", used like the path of a
+# .npz file by synthToAudio (the last character of the key is the part number).
+
+import contextlib
+import fcntl
+import json
+import os
+import tempfile
+import numpy as np
+
+manifest_name = 'manifest.json'
+
+
+class SynthEntry(object):
+    """Arrays of a store entry, opened as read-only memory maps on first access
+
+    Indexed by array name, like the NpzFile returned by np.load.
+    """
+    def __init__(self, store, key, names):
+        self.store = store
+        self.key = key
+        self.files = list(names)
+        self.arrays = {}
+
+    def __getitem__(self, name):
+        if name not in self.arrays:
+            if name not in self.files:
+                raise KeyError('{} is not an array of {}'.format(name, self.key))
+            self.arrays[name] = np.load(self.store.array_path(self.key, name), mmap_mode='r')
+        return self.arrays[name]
+
+    def __contains__(self, name):
+        return name in self.files
+
+    def __iter__(self):
+        return iter(self.files)
+
+    def keys(self):
+        return list(self.files)
+
+
+class SynthStore(object):
+    def __init__(self, directory):
+        self.directory = directory
+        self.manifest = self.read_manifest()
+
+    def read_manifest(self):
+        try:
+            with open(os.path.join(self.directory, manifest_name), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {'entries': {}}
+
+    def array_path(self, key, name):
+        return os.path.join(self.directory, '{}.{}.npy'.format(key, name))
+
+    def keys(self):
+        return sorted(self.manifest['entries'])
+
+    def __contains__(self, key):
+        return key in self.manifest['entries']
+
+    def __getitem__(self, key):
+        return SynthEntry(self, key, self.manifest['entries'][key])
+
+    def shape(self, key, name):
+        return tuple(self.manifest['entries'][key][name]['shape'])
+
+    @contextlib.contextmanager
+    def locked(self):
+        # Several processes can write entries of the same store
+        with open(os.path.join(self.directory, '.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def atomic_write(self, path, write, mode='wb'):
+        # Write to a temporary file of the store, then rename
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix='.tmp')
+        try:
+            with os.fdopen(fd, mode) as f:
+                write(f)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def put(self, key, **arrays):
+        """Write the arrays of an entry (replacing it), then add it to the manifest
+
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        description = {}
+        for name, array in arrays.items():
+            array = np.ascontiguousarray(array)
+            self.atomic_write(self.array_path(key, name), lambda f: np.save(f, array))
+            description[name] = {'shape': list(array.shape), 'dtype': array.dtype.str}
+
+        with self.locked():
+            # Entries written by other processes since this store was opened
+            manifest = self.read_manifest()
+            manifest['entries'][key] = description
+            self.atomic_write(os.path.join(self.directory, manifest_name),
+                              lambda f: json.dump(manifest, f, indent=1, sort_keys=True), mode='w')
+        self.manifest = manifest
+
+    def import_npz(self, npz_path, key=None):
+        # Copy a .npz synth file into the store, under the name of the file by default
+        if key is None:
+            key = os.path.basename(npz_path)[:-4]
+        with np.load(npz_path) as data:
+            self.put(key, **{name: data[name] for name in data.files})
+        return key
+
+
+def is_store_entry(synth_path):
+    return not synth_path.endswith('.npz')
+
+
+_stores = {}
+
+
+def open_store(directory):
+    # SynthStore of a directory, opened again only when its manifest changes
+    try:
+        mtime = os.stat(os.path.join(directory, manifest_name)).st_mtime_ns
+    except FileNotFoundError:
+        mtime = None
+    if directory not in _stores or _stores[directory][0] != mtime:
+        _stores[directory] = (mtime, SynthStore(directory))
+    return _stores[directory][1]
+
+
+def open_synth(synth_path):
+    """Arrays of a synth file : a .npz file, or a store entry "{store directory}/{key}"
+
+    """
+    if not is_store_entry(synth_path):
+        return np.load(synth_path)
+    directory, key = os.path.split(synth_path)
+    return open_store(directory)[key]
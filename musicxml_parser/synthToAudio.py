@@ -1,75 +1,339 @@
-from midi_ddsp import load_pretrained_model
-from midi_ddsp.utils.midi_synthesis_utils import synthesize_mono_midi
-from midi_ddsp.utils.inference_utils import get_process_group
+import functools
 import numpy as np
 import soundfile as sf
 import os
+from .pretrainedModel import get_models
+from .synthStore import open_synth, is_store_entry
+from .fileUtils import atomic_save
 
-synthesis_generator, expression_generator = load_pretrained_model()
+sample_rate = 16000
+# Audio samples per frame of synthesis parameters
+frame_size = 64
+# Frames of parameters rendered around each chunk, so that the envelopes and the noise
+# filter at its edges are the same as in a single pass
+context_frames = 4
+# The processor groups of the single pass are built for lengths multiple of bucket_frames,
+# the parameters being padded up to it, and the max_process_groups last ones are kept
+bucket_frames = 500
+max_process_groups = 8
 
-def exp_sigmoid(x):
-  y = 1 / (1+np.exp(-x))
-  y = y ** np.log(10.0)
-  y = y * 2.0
+def exp_sigmoid(x, out=None):
+  # out : array to compute in (may be x), instead of a new one
+  y = np.negative(x, out=out)
+  np.exp(y, out=y)
+  y += 1
+  np.reciprocal(y, out=y)
+  np.power(y, np.log(10.0), out=y)
+  y *= 2.0
   return y
 
-def rev_exp_sigmoid(y):
-  x = y / 2.0
-  x = x ** (1/np.log(10.0))
-  x  = -np.log((1/x)-1)
+def rev_exp_sigmoid(y, out=None):
+  x = np.divide(y, 2.0, out=out)
+  np.power(x, 1/np.log(10.0), out=x)
+  np.reciprocal(x, out=x)
+  x -= 1
+  np.log(x, out=x)
+  np.negative(x, out=x)
   return x
 
-def synthToAudio(synth_path, interpolation_rate=0.99, save_path=None):
-    data = np.load(synth_path)
+def interpolate_gain(sig_ori, sig_new, interpolation_rate, gain, out=None):
+    """rev_exp_sigmoid of the interpolation of two exp_sigmoid outputs, scaled by gain
 
-    part_num = int(synth_path.split("/")[-1][-5])
-    part_to_inst_dict = {0:0, 1:0, 2:1, 3:2}
-    instrument_id = part_to_inst_dict[part_num]
+    Same as rev_exp_sigmoid(exp_sigmoid(rev_exp_sigmoid(interpolation)) * gain):
+    exp_sigmoid undoes rev_exp_sigmoid, so the interpolation is scaled directly, in a
+    single output array.
+    """
+    out = np.subtract(sig_new, sig_ori, out=out)
+    out *= interpolation_rate
+    out += sig_ori
+    out *= gain
+    return rev_exp_sigmoid(out, out=out)
+
+def sigmoid_params(data):
+    """exp_sigmoid of the original and new amplitudes and noise magnitudes, cut to their
+    common length, and the squared expression
 
-    f0_ori = data['f0_ori']
+    They do not depend on the interpolation rate, so a sweep computes them once.
+    """
     amps_ori = data['amps_ori']
     noise_ori = data['noise_ori']
-    hd_ori = data['hd_ori']
 
     amps_new = data['amps_new']
     noise_new = data['noise_new']
 
     new_length = min(amps_ori.shape[0], amps_new.shape[0])
 
-    inter_amp = (1-interpolation_rate)*exp_sigmoid(amps_ori[:new_length]) + \
-                 interpolation_rate*exp_sigmoid(amps_new[:new_length])
-    amps_changed = rev_exp_sigmoid(inter_amp)[np.newaxis,:,np.newaxis]
+    expression = data['expression']
+    expression2 = np.square(expression)
+
+    return (exp_sigmoid(amps_ori[:new_length]), exp_sigmoid(amps_new[:new_length]),
+            exp_sigmoid(noise_ori[:,:new_length,:]), exp_sigmoid(noise_new[:,:new_length,:]),
+            expression2)
 
-    inter_noise = (1-interpolation_rate)*exp_sigmoid(noise_ori[:,:new_length,:]) + \
-                   interpolation_rate*exp_sigmoid(noise_new[:,:new_length,:])
-    noise_changed = rev_exp_sigmoid(inter_noise)
+def interpolate_params(sigmoids, interpolation_rate=0.99):
+    # Amplitudes and noise magnitudes at one interpolation rate, from sigmoid_params
+    amps_ori, amps_new, noise_ori, noise_new, expression2 = sigmoids
 
-    expression = data['expression']
-    expression2 = expression**2
+    amps_changed = interpolate_gain(amps_ori, amps_new, interpolation_rate, expression2)
+    noise_changed = interpolate_gain(noise_ori, noise_new, interpolation_rate,
+                                     expression2[np.newaxis,:,np.newaxis])
+
+    return amps_changed[np.newaxis,:,np.newaxis], noise_changed
 
-    amps_changed = exp_sigmoid(amps_changed)*expression2[np.newaxis,:,np.newaxis]
-    noise_changed = exp_sigmoid(noise_changed)*expression2[np.newaxis,:,np.newaxis]
+def synth_controls(data, interpolation_rate=0.99):
+    # Frame-wise f0, amplitudes, harmonic distribution and noise magnitudes of a synth file
+    amps_changed, noise_changed = interpolate_params(sigmoid_params(data), interpolation_rate)
+    new_length = amps_changed.shape[1]
+    return data['f0_ori'][:,:new_length,:], amps_changed, data['hd_ori'][:,:new_length,:], noise_changed
+
+def synth_instrument(synth_path):
+    # Reverb of the instrument of a synth file, from its part number
+    part_num = int(synth_path.split("/")[-1][-1 if is_store_entry(synth_path) else -5])
+    part_to_inst_dict = {0:0, 1:0, 2:1, 3:2}
+    return part_to_inst_dict[part_num]
+
+def default_save_path(synth_path, suffix=''):
+    # Next to the synth file (or store entry), with a .wav extension
+    if not is_store_entry(synth_path):
+        synth_path = synth_path[:-4]
+    return "{}{}.wav".format(synth_path, suffix)
+
+def prepare_directory(save_path):
+    directory = "/".join(save_path.split('/')[:-1])
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
 
-    amps_changed = rev_exp_sigmoid(amps_changed)
-    noise_changed = rev_exp_sigmoid(noise_changed)
+@functools.lru_cache(maxsize=max_process_groups)
+def bucket_process_group(n_frames):
+    # midi_ddsp (and tensorflow) are only imported when audio is rendered
+    from midi_ddsp.utils.inference_utils import get_process_group
+    return get_process_group(n_frames, use_angular_cumsum=True)
 
-    processor_group = get_process_group(new_length, use_angular_cumsum=True)
-    midi_audio_changed = processor_group({'amplitudes': amps_changed,
-                                          'harmonic_distribution': hd_ori[:,:new_length,:],
-                                          'noise_magnitudes': noise_changed,
-                                          'f0_hz': f0_ori[:,:new_length,:],},
+def render_audio(f0_hz, amplitudes, harmonic_distribution, noise_magnitudes, instrument_id):
+    # Audio of a batch of synthesis parameters in a single pass, shape (batch, samples)
+    synthesis_generator, _ = get_models()
+
+    # The last frame is repeated up to the bucket length : the envelopes of the real
+    # frames are the same as without padding, and the padding is cut from the audio
+    n_frames = amplitudes.shape[1]
+    padding = [(0, 0), (0, -(-n_frames // bucket_frames) * bucket_frames - n_frames), (0, 0)]
+    processor_group = bucket_process_group(n_frames + padding[1][1])
+    midi_audio_changed = processor_group({'amplitudes': np.pad(amplitudes, padding, mode='edge'),
+                                          'harmonic_distribution': np.pad(harmonic_distribution, padding, mode='edge'),
+                                          'noise_magnitudes': np.pad(noise_magnitudes, padding, mode='edge'),
+                                          'f0_hz': np.pad(f0_hz, padding, mode='edge'),},
                                           verbose=False)
+    midi_audio_changed = midi_audio_changed[:, :n_frames * frame_size]
+
+    if synthesis_generator.reverb_module is not None:
+        midi_audio_changed = synthesis_generator.reverb_module(midi_audio_changed, reverb_number=instrument_id, training=False)
+
+    return midi_audio_changed.numpy()
+
+def reverb_impulse_response(reverb_module, reverb_number=0):
+    # Impulse response applied by the reverb module at inference, dry sample masked
+    import tensorflow as tf
+    from midi_ddsp.modules.reverb_modules import get_exp_decay
+    if reverb_module.num_reverb == 1:
+        reverb_number = 0
+    ir_magnitudes = reverb_module.magnitudes_embedding(tf.constant([reverb_number], dtype=tf.int64))
+    ir_magnitudes = ir_magnitudes * get_exp_decay(reverb_module.reverb_length, 16000, 4)[tf.newaxis, ...]
+    return reverb_module.reverb._mask_dry_ir(ir_magnitudes).numpy()[0]
+
+def render_chunks(f0_hz, amplitudes, harmonic_distribution, noise_magnitudes,
+                  chunk_frames=2500, impulse_response=None, add_dry=True):
+    """Render the synthesis parameters chunk_frames frames at a time, yielding the audio
+    of each chunk as a float32 array
+
+    The phase of the oscillators is carried from a chunk to the next one, and the white
+    noise shared by neighbouring chunks is reused, so the chunks join seamlessly.
+    The reverb of each chunk is overlap-added to the following ones; the tail after the
+    last chunk is dropped, as the single pass does.
+    """
+    import tensorflow as tf
+    import ddsp
+    from ddsp import core
+
+    harmonic_synth = ddsp.synths.Harmonic(sample_rate=sample_rate, use_angular_cumsum=True)
+    noise_synth = ddsp.synths.FilteredNoise()
+    n_harmonics = harmonic_distribution.shape[-1]
+    n_frames = amplitudes.shape[1]
+
+    # Phase of each harmonic at the end of the previous chunk
+    phase = tf.zeros([1, 1, n_harmonics])
+    # White noise of the samples [noise_start, noise_start + len(noise))
+    noise, noise_start = np.zeros(0, dtype=np.float32), 0
+    if impulse_response is not None:
+        ir_size = len(impulse_response)
+        ir_spectra = {}
+        tail = np.zeros(ir_size - 1, dtype=np.float64)
+
+    for start in range(0, n_frames, chunk_frames):
+        end = min(start + chunk_frames, n_frames)
+        first, last = max(start - context_frames, 0), min(end + context_frames, n_frames)
+        n_samples = (last - first) * frame_size
+        keep = slice((start - first) * frame_size, (end - first) * frame_size)
+
+        # Harmonic part, continuing the phase of the previous chunk
+        controls = harmonic_synth.get_controls(amplitudes[:, first:last],
+                                               harmonic_distribution[:, first:last],
+                                               f0_hz[:, first:last])
+        frequency_envelopes = core.resample(controls['f0_hz'], n_samples)[:, keep]
+        amplitude_envelopes = core.resample(controls['amplitudes'] * controls['harmonic_distribution'],
+                                            n_samples, method=harmonic_synth.amp_resample_method)[:, keep]
+        frequency_envelopes = core.get_harmonic_frequencies(frequency_envelopes, n_harmonics)
+        amplitude_envelopes = core.remove_above_nyquist(frequency_envelopes, amplitude_envelopes,
+                                                        sample_rate)
+        # Same phase accumulation as core.oscillator_bank, from the phases the previous
+        # chunk ended with
+        phases = core.angular_cumsum(frequency_envelopes * (2.0 * np.pi / sample_rate)) + phase
+        phase = phases[:, -1:, :] % (2.0 * np.pi)
+        harmonic = tf.reduce_sum(amplitude_envelopes * tf.sin(phases), axis=-1)
+
+        # Noise part, filtered with the context of both sides
+        reused = noise[first * frame_size - noise_start:]
+        noise = np.concatenate([reused, np.random.uniform(
+            -1.0, 1.0, n_samples - len(reused)).astype(np.float32)])
+        noise_start = first * frame_size
+        magnitudes = noise_synth.get_controls(noise_magnitudes[:, first:last])['magnitudes']
+        filtered = core.frequency_filter(noise[np.newaxis], magnitudes,
+                                         window_size=noise_synth.window_size)[:, keep]
+
+        audio = (harmonic + filtered).numpy()[0].astype(np.float64)
+        if impulse_response is not None:
+            size = len(audio)
+            n_fft = 1 << (size + ir_size - 2).bit_length()
+            if n_fft not in ir_spectra:
+                ir_spectra[n_fft] = np.fft.rfft(impulse_response, n_fft)
+            wet = np.fft.irfft(np.fft.rfft(audio, n_fft) * ir_spectra[n_fft], n_fft)[:size + ir_size - 1]
+            wet[:ir_size - 1] += tail
+            tail = wet[size:]
+            audio = wet[:size] + audio if add_dry else wet[:size]
+        yield audio.astype(np.float32)
+
+def render_sweep(f0_hz, amplitudes, harmonic_distribution, noise_magnitudes, instrument_id):
+    """Audio of a batch of amplitudes and noise magnitudes sharing f0_hz and
+    harmonic_distribution (of batch size 1), shape (batch, samples)
+
+    The oscillators of the batch only differ by their amplitudes, so their frequencies,
+    phases and sines are computed once.
+    """
+    import ddsp
+    from ddsp import core
+    synthesis_generator, _ = get_models()
+
+    n_samples = amplitudes.shape[1] * frame_size
+    harmonic_synth = ddsp.synths.Harmonic(n_samples, sample_rate, use_angular_cumsum=True)
+    noise_synth = ddsp.synths.FilteredNoise(n_samples)
+
+    # Same steps as core.harmonic_synthesis, with frequencies of batch size 1
+    controls = harmonic_synth.get_controls(amplitudes, harmonic_distribution, f0_hz)
+    n_harmonics = harmonic_distribution.shape[-1]
+    frequency_envelopes = core.resample(core.get_harmonic_frequencies(controls['f0_hz'], n_harmonics),
+                                        n_samples)
+    amplitude_envelopes = core.resample(controls['amplitudes'] * controls['harmonic_distribution'],
+                                        n_samples, method=harmonic_synth.amp_resample_method)
+    harmonic = core.oscillator_bank(frequency_envelopes, amplitude_envelopes,
+                                    sample_rate=sample_rate, use_angular_cumsum=True)
+    midi_audio_changed = harmonic + noise_synth(noise_magnitudes)
 
     if synthesis_generator.reverb_module is not None:
         midi_audio_changed = synthesis_generator.reverb_module(midi_audio_changed, reverb_number=instrument_id, training=False)
-    
-    final_audio = midi_audio_changed.numpy()
+
+    return midi_audio_changed.numpy()
+
+def synthToAudio(synth_path, interpolation_rate=0.99, save_path=None, chunk_frames=None):
+    # chunk_frames : render and write the audio that many frames (of frame_size samples)
+    # at a time, so that the memory used does not grow with the length of the segment
+    data = open_synth(synth_path)
+    instrument_id = synth_instrument(synth_path)
+
+    f0_hz, amps_changed, harmonic_distribution, noise_changed = synth_controls(data, interpolation_rate)
 
     if save_path is None:
-        save_path = "{}.wav".format(synth_path[:-4])
+        save_path = default_save_path(synth_path)
+    prepare_directory(save_path)
 
-    directory = "/".join(save_path.split('/')[:-1])
-    if not os.path.exists(directory):
-        os.makedirs(directory)
+    if chunk_frames is not None:
+        synthesis_generator, _ = get_models()
+        reverb_module = synthesis_generator.reverb_module
+        if reverb_module is not None:
+            impulse_response = reverb_impulse_response(reverb_module, instrument_id)
+            add_dry = reverb_module.reverb._add_dry
+        else:
+            impulse_response, add_dry = None, True
+
+        def write_chunks(path):
+            with sf.SoundFile(path, 'w', samplerate=sample_rate, channels=1) as wav:
+                for audio in render_chunks(f0_hz, amps_changed, harmonic_distribution, noise_changed,
+                                           chunk_frames, impulse_response, add_dry):
+                    wav.write(audio)
+        # A render stopped midway leaves no partial WAV at save_path (see valid_audio)
+        atomic_save(save_path, write_chunks)
+        return
+
+    final_audio = render_audio(f0_hz, amps_changed, harmonic_distribution, noise_changed, instrument_id)
+
+    atomic_save(save_path, lambda path: sf.write(path, final_audio[0], samplerate=sample_rate))
+
+def synthSweep(synth_path, interpolation_rates, save_paths=None):
+    """Render a synth file at several interpolation rates
+
+    The file is loaded and its sigmoids computed once, then the controls of all the
+    rates are rendered as one batch, sharing their oscillators (see render_sweep).
+    save_paths : one path per rate, by default the synth path followed by the rate.
+    Returns the save paths.
+    """
+    data = open_synth(synth_path)
+    instrument_id = synth_instrument(synth_path)
+    if save_paths is None:
+        save_paths = [default_save_path(synth_path, "_{:g}".format(rate)) for rate in interpolation_rates]
+
+    sigmoids = sigmoid_params(data)
+    controls = [interpolate_params(sigmoids, rate) for rate in interpolation_rates]
+    amplitudes = np.concatenate([amps for amps, _ in controls])
+    noise_magnitudes = np.concatenate([noise for _, noise in controls])
+    new_length = amplitudes.shape[1]
+    f0_hz = data['f0_ori'][:,:new_length,:]
+    harmonic_distribution = data['hd_ori'][:,:new_length,:]
+
+    final_audio = render_sweep(f0_hz, amplitudes, harmonic_distribution, noise_magnitudes, instrument_id)
+
+    for audio, save_path in zip(final_audio, save_paths):
+        prepare_directory(save_path)
+        atomic_save(save_path, lambda path: sf.write(path, audio, samplerate=sample_rate))
+    return save_paths
+
+
+if __name__ == '__main__':
+    # Benchmark of interpolate_params against the step by step transforms it replaces
+    import time
+    frames, rates = 250*120, 5
+    rng = np.random.RandomState(0)
+    data = {'amps_ori': rng.normal(-3, 1, frames).astype(np.float32),
+            'amps_new': rng.normal(-3, 1, frames).astype(np.float32),
+            'noise_ori': rng.normal(-5, 2, (1, frames, 65)).astype(np.float32),
+            'noise_new': rng.normal(-5, 2, (1, frames, 65)).astype(np.float32),
+            'expression': rng.uniform(0.3, 1, frames).astype(np.float32)}
+
+    def step_by_step(data, interpolation_rate):
+        expression2 = (data['expression']**2)[np.newaxis,:,np.newaxis]
+        inter_amp = (1-interpolation_rate)*exp_sigmoid(data['amps_ori']) + \
+                     interpolation_rate*exp_sigmoid(data['amps_new'])
+        amps_changed = rev_exp_sigmoid(inter_amp)[np.newaxis,:,np.newaxis]
+        inter_noise = (1-interpolation_rate)*exp_sigmoid(data['noise_ori']) + \
+                       interpolation_rate*exp_sigmoid(data['noise_new'])
+        noise_changed = rev_exp_sigmoid(inter_noise)
+        amps_changed = rev_exp_sigmoid(exp_sigmoid(amps_changed)*expression2)
+        noise_changed = rev_exp_sigmoid(exp_sigmoid(noise_changed)*expression2)
+        return amps_changed, noise_changed
 
-    sf.write(save_path, final_audio[0], samplerate=16000)
\ No newline at end of file
+    start = time.time()
+    expected = [step_by_step(data, 0.5 + 0.1*n) for n in range(rates)]
+    middle = time.time()
+    sigmoids = sigmoid_params(data)
+    fused = [interpolate_params(sigmoids, 0.5 + 0.1*n) for n in range(rates)]
+    end = time.time()
+    error = max(np.abs(a - b).max() for pair, other in zip(expected, fused) for a, b in zip(pair, other))
+    print('{} frames, {} rates : step by step {:.3f}s, fused {:.3f}s, max difference {:.2e}'.format(
+        frames, rates, middle - start, end - middle, error))
@@ -0,0 +1,38 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+
+# Shortest note of the tempo section a time belongs to.
+# shortest_notes maps the start time of each tempo section to the length of its shortest
+# notes (see xmlToData.shortest_notes_from_durations). A time belongs to the last
+# section starting before or at it. The start times are sorted once, then each lookup
+# is a binary search.
+
+import bisect
+import numpy as np
+
+
+class ShortestNoteIndex(object):
+    def __init__(self, shortest_notes):
+        self.starts = sorted(shortest_notes.keys())
+        self.lengths = [shortest_notes[start] for start in self.starts]
+        self.starts_array = np.array(self.starts)
+        self.lengths_array = np.array(self.lengths, dtype=np.float64)
+
+    def __call__(self, time):
+        """Shortest note at time
+
+        Raise a ValueError when no tempo section starts before time
+        """
+        position = bisect.bisect_right(self.starts, time) - 1
+        if position < 0:
+            raise ValueError('No tempo section before time {}'.format(time))
+        return self.lengths[position]
+
+    def lookup_many(self, times):
+        """Shortest notes at an array of times
+
+        """
+        positions = np.searchsorted(self.starts_array, times, side='right') - 1
+        if np.any(positions < 0):
+            raise ValueError('No tempo section before time {}'.format(np.min(times)))
+        return self.lengths_array[positions]
@@ -1,17 +1,53 @@
-from .scoreToDurationList import scoreToPianorolld
-from .scoreToPianoroll import scoreToPianoroll
+from .scoreCollector import collect_score, replay_events
+from .scoreSource import parse_score
+from .scoreCache import read_score, score_digest
+from .scoreToPianoroll import ScoreToPianorollHandler, build_pianoroll
 import numpy as np
 
-def xmlToData(score_path, quantization=96):
-    pianoroll, articulation, score = scoreToPianorolld(score_path, quantization)
-    key = list(pianoroll.keys())[0]
-
+def shortest_notes_from_durations(duration_list):
+    # Mean of the 5% shortest notes of each tempo section
     shortest_notes = {}
-    for d_key in score.duration_list.keys():
-        lst = score.duration_list[d_key]
+    for d_key in duration_list.keys():
+        lst = duration_list[d_key]
         if len(lst)//20 > 1:
             shortest_notes[d_key] = np.mean(sorted(lst)[:len(lst)//20])
+    return shortest_notes
+
+def parse_pianoroll_handler(score_path, quantization=96, cache=None):
+    # cache : a scoreCache.ScoreStatsCache. When the score is in it, the file is parsed
+    # once by the pianoroll handler, without the total length and durations pre-pass
+    if cache is None:
+        content = score_path
+        stats = None
+    else:
+        content = read_score(score_path)
+        digest = score_digest(content)
+        stats = cache.get(digest, quantization)
+
+    if stats is None:
+        # One pass over the file gives the total length, the durations and the buffered events
+        collector = collect_score(content, quantization)
+        shortest_notes = shortest_notes_from_durations(collector.duration_list)
+        if cache is not None:
+            cache.put(digest, quantization, collector.total_length, shortest_notes)
+        Handler_score = ScoreToPianorollHandler(quantization, int(collector.total_length), shortest_notes)
+        return replay_events(collector.events, Handler_score)
+
+    total_length, shortest_notes = stats
+    Handler_score = ScoreToPianorollHandler(quantization, int(total_length), shortest_notes)
+    return parse_score(content, Handler_score)
+
+def xmlToData(score_path, quantization=96, cache=None):
+    pianoroll, articulation, score = build_pianoroll(parse_pianoroll_handler(score_path, quantization, cache))
+    key = list(pianoroll.keys())[0]
+
+    return pianoroll[key], articulation[key], score.dynamics
+
 
-    pianoroll, articulation, score = scoreToPianoroll(score_path, quantization, shortest_notes)
+def xmlToNotes(score_path, quantization=96, cache=None):
+    # Note table (see scoreToPianoroll.note_event_dtype) instead of dense rolls.
+    # Use scoreToPianoroll.notesToPianoroll to get a roll, len(dynamics) is the number of frames
+    score = parse_pianoroll_handler(score_path, quantization, cache)
+    key = list(score.notes.keys())[0]
 
-    return pianoroll[key], articulation[key], score.dynamics
\ No newline at end of file
+    return score.notes[key], score.dynamics
@@ -1,37 +1,110 @@
-from .xmlToData import xmlToData
-from .reverse_pianoroll import piano_roll_to_pretty_midi
+from .xmlToData import xmlToData, xmlToNotes
+from .scoreToPianoroll import ROLL, ARTICULATION
+from .reverse_pianoroll import piano_roll_to_pretty_midi, piano_roll_to_midi_bytes, \
+    notes_to_pretty_midi, notes_to_midi_bytes, piano_roll_notes
 import numpy as np
 
-def monophonic(pianoroll):
-    roll_nonzero = (pianoroll != 0)
-    for i in range(pianoroll.shape[0]):
-        if np.sum(roll_nonzero[i]) > 1:
-            pitches = [i for i, x in enumerate(roll_nonzero[i]) if x]
-            highest_pitch = np.max(pitches)
-            pianoroll[i][:highest_pitch] = 0
+def monophonic(pianoroll, mode='highest'):
+    """Keep a single pitch in each frame of a (..., time, pitch) pianoroll
+
+    mode : 'highest', 'lowest' or 'recent' (the pitch with the latest onset, the highest
+    one on equal onsets). Stacked rolls (e.g. np.stack([roll, art])) are reduced at once,
+    each one independently. The pianoroll is modified in place and returned.
+    """
+    active = (pianoroll != 0)
+    number_pitches = pianoroll.shape[-1]
+    if mode == 'highest':
+        keep = number_pitches - 1 - np.argmax(active[..., ::-1], axis=-1)
+    elif mode == 'lowest':
+        keep = np.argmax(active, axis=-1)
+    elif mode == 'recent':
+        # Frame of the last onset of each active pitch, -1 where the pitch is off
+        onsets = active.copy()
+        onsets[..., 1:, :] &= ~active[..., :-1, :]
+        frames = np.arange(pianoroll.shape[-2], dtype=np.int32)[:, None]
+        onset_time = np.where(onsets, frames, np.int32(-1))
+        np.maximum.accumulate(onset_time, axis=-2, out=onset_time)
+        onset_time[~active] = -1
+        keep = number_pitches - 1 - np.argmax(onset_time[..., ::-1], axis=-1)
+    else:
+        raise ValueError("Unknown monophonic mode {}".format(mode))
+    pianoroll[np.arange(number_pitches) != keep[..., None]] = 0
     return pianoroll
 
-def xmlToMidi(xml_paths, quantization=96, programs=[40,40,40,40,41,41,42,42], save_path=None):
+def monophonic_notes(notes, flags=ROLL, mode='highest', number_pitches=128):
+    """Notes of a note table (see scoreToPianoroll.note_event_dtype) after monophonic,
+    as the (pitch, start, end) arrays of reverse_pianoroll.piano_roll_notes
+
+    Same result as going through notesToPianoroll, but the roll is only built on the
+    segments between consecutive note boundaries instead of every frame.
+    """
+    selected = notes[((notes['flags'] & flags) != 0) & (notes['end'] > notes['start'])]
+    bounds = np.unique(np.concatenate([selected['start'], selected['end']]))
+    # Number of notes playing each pitch in the segment [bounds[i], bounds[i+1])
+    segments = np.zeros((len(bounds), number_pitches), dtype=np.int32)
+    np.add.at(segments, (np.searchsorted(bounds, selected['start']), selected['pitch']), 1)
+    np.add.at(segments, (np.searchsorted(bounds, selected['end']), selected['pitch']), -1)
+    np.cumsum(segments, axis=0, out=segments)
+    pitches, starts, ends = piano_roll_notes(monophonic(segments, mode).T)
+    return pitches, bounds[starts].astype(np.int64), bounds[ends].astype(np.int64)
+
+def xmlToRolls(xml_paths, quantization=96, cache=None, mode='highest'):
     rolls = []
     # arts = []
     dyns = []
 
     for xml_path in xml_paths:
         print('---')
-        roll, art, dyn = xmlToData(xml_path, quantization)
+        roll, art, dyn = xmlToData(xml_path, quantization, cache)
 
         # only for strictly monophonic model
-        roll = monophonic(roll)
-        art = monophonic(art)
+        roll, art = monophonic(np.stack([roll, art]), mode)
 
         rolls.append(roll.T)
         rolls.append(art.T)
         dyns.append(dyn)
         dyns.append(None)
 
-    mid = piano_roll_to_pretty_midi(rolls, dynamics=dyns, fs=quantization, programs=programs)
+    return rolls, dyns
+
+def xmlToNoteLists(xml_paths, quantization=96, cache=None, mode='highest'):
+    # Same notes as piano_roll_notes on the rolls of xmlToRolls, without the rolls
+    note_lists = []
+    dyns = []
+
+    for xml_path in xml_paths:
+        print('---')
+        notes, dyn = xmlToNotes(xml_path, quantization, cache)
+
+        # only for strictly monophonic model
+        note_lists.append(monophonic_notes(notes, ROLL, mode))
+        note_lists.append(monophonic_notes(notes, ARTICULATION, mode))
+        dyns.append(dyn)
+        dyns.append(None)
+
+    return note_lists, dyns
+
+def xmlToPrettyMidi(xml_paths, quantization=96, programs=[40,40,40,40,41,41,42,42], cache=None, mode='highest', direct=True):
+    # direct : go from the parsed notes to the midi notes, without the dense rolls
+    if direct:
+        note_lists, dyns = xmlToNoteLists(xml_paths, quantization, cache, mode)
+        return notes_to_pretty_midi(note_lists, dynamics=dyns, fs=quantization, programs=programs)
+    rolls, dyns = xmlToRolls(xml_paths, quantization, cache, mode)
+    return piano_roll_to_pretty_midi(rolls, dynamics=dyns, fs=quantization, programs=programs)
+
+def xmlToMidiBytes(xml_paths, quantization=96, programs=[40,40,40,40,41,41,42,42], cache=None, mode='highest', direct=True):
+    # Content of the .mid file written by xmlToMidi, without the pretty_midi objects
+    if direct:
+        note_lists, dyns = xmlToNoteLists(xml_paths, quantization, cache, mode)
+        return notes_to_midi_bytes(note_lists, dynamics=dyns, fs=quantization, programs=programs)
+    rolls, dyns = xmlToRolls(xml_paths, quantization, cache, mode)
+    return piano_roll_to_midi_bytes(rolls, dynamics=dyns, fs=quantization, programs=programs)
+
+def xmlToMidi(xml_paths, quantization=96, programs=[40,40,40,40,41,41,42,42], save_path=None, cache=None, mode='highest', direct=True):
+    mid = xmlToMidiBytes(xml_paths, quantization, programs, cache, mode, direct)
 
     if save_path is None:
         save_path = ".".join(xml_paths[0].split('.')[:-1])
-        
-    mid.write("{}_all.mid".format(save_path))
\ No newline at end of file
+
+    with open("{}_all.mid".format(save_path), 'wb') as f:
+        f.write(mid)
@@ -0,0 +1,135 @@
+# Checkpoints of train.py : state_dicts (model, optimizer, scheduler, grad scaler),
+# counters and random generator states, written by a background thread.
+# The training loop only waits for a copy of the state to the CPU; torch.save and the
+# removal of old checkpoints happen while it continues. The last keep_last
+# checkpoints and the keep_best ones with the lowest metric are kept, listed in
+# checkpoints.json.
+
+import inspect
+import json
+import os
+import random
+import tempfile
+import threading
+import numpy as np
+import torch
+
+# torch.load only takes weights_only from torch 1.13 (the Dockerfile image has torch 1.10)
+load_options = {'weights_only': False} if 'weights_only' in inspect.signature(torch.load).parameters else {}
+
+
+def snapshot(state):
+    # Copy of a (nested) state on the CPU, independent from the training tensors
+    if isinstance(state, torch.Tensor):
+        return state.detach().to('cpu', copy=True)
+    if isinstance(state, dict):
+        return {key: snapshot(value) for key, value in state.items()}
+    if isinstance(state, (list, tuple)):
+        return type(state)(snapshot(value) for value in state)
+    return state
+
+
+def rng_state():
+    state = {'python': random.getstate(), 'numpy': np.random.get_state(),
+             'torch': torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+class CheckpointManager(object):
+    def __init__(self, directory, keep_last=3, keep_best=2):
+        self.directory = directory
+        self.keep_last = keep_last
+        self.keep_best = keep_best
+        os.makedirs(directory, exist_ok=True)
+        self.index_path = os.path.join(directory, 'checkpoints.json')
+        self.entries = []
+        if os.path.exists(self.index_path):
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                self.entries = json.load(f)
+        self.thread = None
+        self.error = None
+
+    def save(self, step, state, metric=None):
+        """Checkpoint state (a dict of state_dicts and values) at step
+
+        Returns once the state is copied to the CPU, the file is written in the background.
+        """
+        cpu_state = snapshot(state)
+        # One checkpoint written at a time
+        self.wait()
+        self.thread = threading.Thread(target=self.write, args=(step, cpu_state, metric), daemon=True)
+        self.thread.start()
+
+    def wait(self):
+        # Wait for the checkpoint being written, raising its error if it failed
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError('Checkpoint could not be saved') from error
+
+    def write(self, step, cpu_state, metric):
+        try:
+            name = 'step{:08d}.pt'.format(step)
+            self.atomic_write(os.path.join(self.directory, name), lambda f: torch.save(cpu_state, f), 'wb')
+            self.entries = [entry for entry in self.entries if entry['name'] != name]
+            self.entries.append({'name': name, 'step': step, 'metric': metric})
+            self.prune()
+        except BaseException as error:
+            self.error = error
+
+    def prune(self):
+        last = sorted(self.entries, key=lambda entry: entry['step'])[-self.keep_last:] if self.keep_last else []
+        scored = [entry for entry in self.entries if entry['metric'] is not None]
+        best = sorted(scored, key=lambda entry: entry['metric'])[:self.keep_best]
+        kept = {entry['name'] for entry in last + best}
+        removed = [entry for entry in self.entries if entry['name'] not in kept]
+        self.entries = [entry for entry in self.entries if entry['name'] in kept]
+        # The index never lists a removed file
+        self.atomic_write(self.index_path, lambda f: json.dump(self.entries, f, indent=1), 'w')
+        for entry in removed:
+            try:
+                os.remove(os.path.join(self.directory, entry['name']))
+            except OSError:
+                pass
+
+    def atomic_write(self, path, write, mode):
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix='.tmp')
+        try:
+            with os.fdopen(fd, mode) as f:
+                write(f)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def latest(self):
+        # Path of the last checkpoint, None if there is none
+        if not self.entries:
+            return None
+        return os.path.join(self.directory, max(self.entries, key=lambda entry: entry['step'])['name'])
+
+    def best(self):
+        scored = [entry for entry in self.entries if entry['metric'] is not None]
+        if not scored:
+            return None
+        return os.path.join(self.directory, min(scored, key=lambda entry: entry['metric'])['name'])
+
+    def load(self, path=None, map_location='cpu'):
+        # State of a checkpoint, the latest one by default
+        self.wait()
+        path = self.latest() if path is None else path
+        # The generator states are not tensors
+        return torch.load(path, map_location=map_location, **load_options)
@@ -0,0 +1,89 @@
+# Input pipeline of train.py : DataLoader with worker processes and pinned memory,
+# non-blocking copies to the device, and the normalization, gain augmentation and
+# mixing done there on the whole batch.
+
+import time
+import torch
+from torch.utils.data import DataLoader
+
+
+def make_loader(dataset, batch_size, shuffle, num_workers=8, device='cuda', prefetch_factor=4):
+    """DataLoader of dataset, pinned batches being copied asynchronously
+
+    The shuffling and the seeds of the workers come from loader.generator : its state
+    (get_state / set_state) is saved with the checkpoints, for an exact resume.
+    """
+    # Drawn from the global generator once, at creation
+    generator = torch.Generator().manual_seed(int(torch.randint(2**62, ())))
+    options = {}
+    if hasattr(dataset, 'sampler'):
+        # Random draws of the dataset made in the main process (stem_dataset.WindowSampler)
+        options['sampler'] = dataset.sampler(shuffle)
+        shuffle = False
+    if num_workers > 0:
+        # Workers drawing random numbers are started again every epoch, seeded from the
+        # generator, so that a resumed epoch draws the same ones; the others are kept
+        options.update(persistent_workers='sampler' in options, prefetch_factor=prefetch_factor)
+    return DataLoader(dataset, batch_size=batch_size, shuffle=shuffle, num_workers=num_workers,
+                      pin_memory=str(device).startswith('cuda'), generator=generator, **options)
+
+
+def prepare_batch(data, device, scale=1.0):
+    """Stems (batch, n_stems, samples) on the device, in float32, divided by their mean
+    as train.py did on the CPU
+
+    scale : of int16 stems (StemWindowDataset with dtype=None).
+    """
+    data = data.to(device, non_blocking=True).float()
+    if scale != 1.0:
+        data *= scale
+    return data / (data.mean(axis=[1, 2]) + 1e-16).unsqueeze(1).unsqueeze(2)
+
+
+def random_gain(audio, min_gain_in_db, max_gain_in_db, p):
+    # Gain of torch_audiomentations (per example, with probability p), for a whole batch
+    # (batch, channels, samples) on its device
+    batch_size = audio.shape[0]
+    gain_db = torch.empty(batch_size, device=audio.device).uniform_(min_gain_in_db, max_gain_in_db)
+    applied = torch.rand(batch_size, device=audio.device) < p
+    gains = torch.where(applied, 10.0 ** (gain_db / 20.0), torch.ones_like(gain_db))
+    return audio * gains[:, None, None]
+
+
+def augment_and_mix(labels):
+    # Gain of the whole example, then of the first stem; the input is the sum of the stems
+    labels = random_gain(labels, -5.0, 0.0, 0.3)
+    labels = torch.cat([random_gain(labels[:, 0:1, :], -3.0, 3.0, 0.3), labels[:, 1:2, :]], axis=1)
+    inputs = labels.sum(axis=1).unsqueeze(1)
+    return inputs, labels
+
+
+class Throughput(object):
+    """Samples per second of the training loop, and the share of its time spent waiting
+    for the loader (close to 1 : input-bound)
+
+    Call batch_ready() when a batch is received, step_done(batch_size) at the end of
+    the step, then report() to get and reset the statistics.
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.start = self.last = time.perf_counter()
+        self.samples = 0
+        self.waiting = 0.0
+
+    def batch_ready(self):
+        now = time.perf_counter()
+        self.waiting += now - self.last
+        self.last = now
+
+    def step_done(self, batch_size):
+        self.samples += batch_size
+        self.last = time.perf_counter()
+
+    def report(self):
+        elapsed = max(time.perf_counter() - self.start, 1e-9)
+        statistics = {'samples_per_s': self.samples / elapsed, 'input_wait': self.waiting / elapsed}
+        self.reset()
+        return statistics
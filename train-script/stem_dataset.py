@@ -0,0 +1,145 @@
+# Pre-rendered stem dataset for train.py.
+# build_stem_dataset decodes the WAVs written by synthToAudio once, into a single
+# memory-mapped stem matrix (stems.npy, shape (n_stems, total_samples), float16 or
+# int16) and an index of fixed-length windows (windows.npy, window starts which never
+# cross the end of a track). StemWindowDataset then serves windows by slicing the
+# memory map : no decoding, and only the pages of the window are read.
+
+import json
+import os
+import numpy as np
+import soundfile as sf
+import torch
+from torch.utils.data import Dataset, Sampler
+
+int16_scale = 1.0 / 32767
+
+
+def format_tracks(path_format, splits, parts):
+    # Tracks of build_stem_dataset from the WAVs of generate_audio_from_synth,
+    # e.g. format_tracks("piece/{:02d}_{:01d}.wav", 16, [0, 2]) for two stems
+    return [[path_format.format(split, part) for part in parts] for split in range(splits)]
+
+
+def build_stem_dataset(tracks, directory, sample_rate=16000, window_seconds=5.0, hop_seconds=None,
+                       dtype='float16', block_size=2**20):
+    """Write the stems of tracks into directory
+
+    tracks : list of tracks, each a list of one WAV path per stem (same stems, in the
+        same order, for every track). Stems of a track are cut to the shortest one.
+    hop_seconds : step between two windows of a track, window_seconds by default.
+    dtype : 'float16', or 'int16' for 16 bit PCM (audio clipped to [-1, 1]).
+    """
+    os.makedirs(directory, exist_ok=True)
+    n_stems = len(tracks[0])
+    lengths = []
+    for stem_paths in tracks:
+        if len(stem_paths) != n_stems:
+            raise ValueError('{} has {} stems instead of {}'.format(stem_paths, len(stem_paths), n_stems))
+        infos = [sf.info(path) for path in stem_paths]
+        for path, info in zip(stem_paths, infos):
+            if info.samplerate != sample_rate:
+                raise ValueError('{} is sampled at {} Hz instead of {}'.format(path, info.samplerate, sample_rate))
+        lengths.append(min(info.frames for info in infos))
+
+    offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+    stems = np.lib.format.open_memmap(os.path.join(directory, 'stems.npy'), mode='w+',
+                                      dtype=np.dtype(dtype), shape=(n_stems, int(offsets[-1])))
+    for stem_paths, offset, length in zip(tracks, offsets, lengths):
+        for n, path in enumerate(stem_paths):
+            position = offset
+            for block in sf.blocks(path, blocksize=block_size, dtype='float32', frames=length, always_2d=True):
+                # Mono stems (the first channel of multichannel files)
+                block = block[:, 0]
+                if dtype == 'int16':
+                    block = np.round(np.clip(block, -1.0, 1.0) / int16_scale)
+                stems[n, position:position + len(block)] = block
+                position += len(block)
+    stems.flush()
+    del stems
+
+    window = int(round(window_seconds * sample_rate))
+    hop = window if hop_seconds is None else int(round(hop_seconds * sample_rate))
+    windows = [np.arange(offset, offset + length - window + 1, hop, dtype=np.int64)
+               for offset, length in zip(offsets, lengths)]
+    np.save(os.path.join(directory, 'windows.npy'), np.concatenate(windows))
+
+    with open(os.path.join(directory, 'stems.json'), 'w', encoding='utf-8') as f:
+        json.dump({'sample_rate': sample_rate, 'window': window, 'hop': hop, 'dtype': dtype,
+                   'scale': int16_scale if dtype == 'int16' else 1.0,
+                   'tracks': [list(stem_paths) for stem_paths in tracks],
+                   'offsets': offsets.tolist()}, f, indent=1)
+
+
+class StemWindowDataset(Dataset):
+    """Windows of a directory written by build_stem_dataset, as (n_stems, window) tensors
+
+    random_offset : shift each window by a random amount below the hop (staying in its
+        track), so that the epochs do not all see the same cuts.
+    dtype : dtype of the windows, None to keep the storage dtype (to convert them on the
+        device, after multiplying by the "scale" of the metadata for int16).
+    """
+    def __init__(self, directory, random_offset=True, dtype=torch.float32):
+        with open(os.path.join(directory, 'stems.json'), 'r', encoding='utf-8') as f:
+            self.metadata = json.load(f)
+        # Copy-on-write : writable arrays for torch, without writing to the file
+        self.stems = np.load(os.path.join(directory, 'stems.npy'), mmap_mode='c')
+        self.windows = np.load(os.path.join(directory, 'windows.npy'))
+        self.window = self.metadata['window']
+        self.random_offset = random_offset
+        self.dtype = dtype
+        self.scale = self.metadata['scale']
+        if random_offset:
+            # Last start of each window inside its track
+            offsets = np.asarray(self.metadata['offsets'])
+            track_ends = offsets[np.searchsorted(offsets, self.windows, side='right')]
+            self.last_starts = np.minimum(self.windows + self.metadata['hop'] - 1, track_ends - self.window)
+
+    def __len__(self):
+        return len(self.windows)
+
+    def __getitem__(self, index):
+        if isinstance(index, tuple):
+            # From WindowSampler : shift drawn in the main process, in [0, 1)
+            index, shift = index
+            start = int(self.windows[index])
+            start += int(shift * (self.last_starts[index] - start + 1))
+        else:
+            start = int(self.windows[index])
+            if self.random_offset:
+                # torch's generator is seeded differently in each DataLoader worker
+                start = int(torch.randint(start, int(self.last_starts[index]) + 1, ()))
+        window = torch.from_numpy(self.stems[:, start:start + self.window])
+        if self.dtype is None:
+            return window
+        window = window.to(self.dtype)
+        if self.scale != 1.0:
+            window *= self.scale
+        return window
+
+    def sampler(self, shuffle=True):
+        return WindowSampler(self, shuffle)
+
+
+class WindowSampler(Sampler):
+    """Order of the windows of a StemWindowDataset and their random shifts, as
+    (index, shift) pairs
+
+    Everything is drawn in the main process with torch's generator, so restoring its
+    state (checkpoint.set_rng_state) replays the same epoch, whatever the DataLoader
+    workers did before.
+    """
+    def __init__(self, dataset, shuffle=True):
+        self.dataset = dataset
+        self.shuffle = shuffle
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __iter__(self):
+        n = len(self.dataset)
+        order = torch.randperm(n) if self.shuffle else torch.arange(n)
+        if not self.dataset.random_offset:
+            return iter(order.tolist())
+        shifts = torch.rand(n).tolist()
+        return iter([(index, shifts[index]) for index in order.tolist()])
@@ -15,40 +15,38 @@ warmup = True
 
 model_num = '0'
 batch_size = 16
-
-train_dataset = load_data('URMP')   # ('MDDSP')
-val_dataset = load_data('URMP', 'test')   # ('MDDSP', 'test')
+# Mixed precision (float16 with loss scaling on CUDA, bfloat16 on CPU), and batches
+# accumulated per optimizer update : effective batch of batch_size*accumulation_steps
+amp = False
+accumulation_steps = 1
+# Continue from the latest checkpoint of model{model_num}/checkpoints
+resume = False
+
+# Directory with train/ and test/ stem datasets written by stem_dataset.build_stem_dataset,
+# read instead of load_data when set
+stem_dir = None
+
+if stem_dir is not None:
+    from stem_dataset import StemWindowDataset
+    # Stems sent to the device in their storage dtype, converted there
+    train_dataset = StemWindowDataset(f'{stem_dir}/train', dtype=None)
+    val_dataset = StemWindowDataset(f'{stem_dir}/test', random_offset=False, dtype=None)
+else:
+    train_dataset = load_data('URMP')   # ('MDDSP')
+    val_dataset = load_data('URMP', 'test')   # ('MDDSP', 'test')
 
 device = 'cuda'
+num_workers = 8
+
+# Gain augmentation and mixing run on the device (pipeline.augment_and_mix)
+from pipeline import make_loader, prepare_batch, augment_and_mix, Throughput
 
-from torch_audiomentations import Compose, Gain, PitchShift, ApplyImpulseResponse
-
-# Initialize augmentation callable
-apply_augmentation = Compose(
-    transforms=[
-        Gain(
-            min_gain_in_db=-5.0,
-            max_gain_in_db=0.0,
-            p=0.3,
-        ),
-    ]
-)
-
-separate_augmentation0 = Compose(
-    transforms=[
-        Gain(
-            min_gain_in_db=-3.0,
-            max_gain_in_db=3.0,
-            p=0.3,
-        ),
-    ]
-)
-
-from torch.utils.data import DataLoader
-
-trainloader = DataLoader(train_dataset, batch_size=batch_size, shuffle=True)
+trainloader = make_loader(train_dataset, batch_size, True, num_workers, device)
 dataset_length = len(train_dataset)
-valloader = DataLoader(val_dataset, batch_size=batch_size, shuffle=False)
+valloader = make_loader(val_dataset, batch_size, False, num_workers, device)
+# Of int16 stems
+train_scale = getattr(train_dataset, 'scale', 1.0)
+val_scale = getattr(val_dataset, 'scale', 1.0)
 
 import torch.optim as optim
 from torch.optim.lr_scheduler import StepLR
@@ -68,68 +66,85 @@ model = model.to(device)
 
 scheduler = StepLR(optimizer, step_size=1, gamma=0.1)
 
+from train_step import TrainStep
+max_norm = 5
+train_step = TrainStep(model, optimizer, criterion, device, amp, accumulation_steps, max_norm)
+
 num_epochs = 150
 update_epochs = [30,60,90,120]
 
-torch.save(model, f'model{model_num}/01.pkl')
+from checkpoint import CheckpointManager, rng_state, set_rng_state
+# Checkpoint of every epoch written in the background : the last 3, and the 2 best ones
+checkpoints = CheckpointManager(f'model{model_num}/checkpoints', keep_last=3, keep_best=2)
+
 best_val_loss = 1e10
 steps = 0
-
-for epoch in range(num_epochs):  # loop over the dataset multiple times
+# Optimizer updates, for the warmup
+updates = 0
+start_epoch = 0
+
+if resume and checkpoints.latest() is not None:
+    ckpt = checkpoints.load()
+    model.load_state_dict(ckpt['model'])
+    optimizer.load_state_dict(ckpt['optimizer'])
+    scheduler.load_state_dict(ckpt['scheduler'])
+    train_step.scaler.load_state_dict(ckpt['scaler'])
+    trainloader.generator.set_state(ckpt['loader'])
+    steps, updates, best_val_loss = ckpt['steps'], ckpt['updates'], ckpt['best_val_loss']
+    start_epoch = ckpt['epoch'] + 1
+    # Last, so that the next epoch draws the same batches and augmentations
+    set_rng_state(ckpt['rng'])
+    print(f'Resuming at epoch {start_epoch + 1}')
+
+for epoch in range(start_epoch, num_epochs):  # loop over the dataset multiple times
     # training step
     model.train()
     running_loss = 0.0
     total_loss = 0.0
-    max_norm = 5
+    throughput = Throughput()
     
     for i, data in enumerate(trainloader, 0):
+        throughput.batch_ready()
         steps += 1
-        if (steps < 300) and warmup:
-            # learning rate warmup
-            lr = init_lr*steps/300
+        if (updates + 1 < 300) and warmup:
+            # learning rate warmup, of the next update
+            lr = init_lr*(updates + 1)/300
             for g in optimizer.param_groups:
                 g['lr'] = lr
                 
-        # get the inputs; data is a list of [inputs, labels]
-        labels = data/(data.mean(axis=[1,2])+1e-16).unsqueeze(1).unsqueeze(2)
-        labels = apply_augmentation(labels)
-        labels = torch.cat([separate_augmentation0(labels[:,0:1,:]), 
-                            labels[:,1:2,:]], axis=1)
-        
-        inputs = labels.sum(axis=1).unsqueeze(1)
-        
-        labels = labels.to(device)
-        inputs = inputs.to(device)
+        # get the inputs; data is a batch of stems, mixed on the device
+        labels = prepare_batch(data, device, train_scale)
+        inputs, labels = augment_and_mix(labels)
 
-        # zero the parameter gradients
-        optimizer.zero_grad()
-
-        # forward + backward + optimize
-        outputs = model(inputs).squeeze(dim=2)
-        loss = -criterion(outputs, labels)
-        loss.backward()
-        torch.nn.utils.clip_grad_norm_(model.parameters(), max_norm)
-        optimizer.step()
+        # forward + backward, optimize every accumulation_steps batches
+        loss, updated = train_step(inputs, labels)
+        updates += updated
 
         # print statistics
         running_loss += loss.item()
         total_loss += loss.item()
+        throughput.step_done(inputs.shape[0])
         
         if i % 50 == 49:    # print every 2000 mini-batches
-            print(f'\r[{epoch + 1}, {i + 1:5d}] loss: {running_loss / 5:.5f}')
+            rates = throughput.report()
+            print(f'\r[{epoch + 1}, {i + 1:5d}] loss: {running_loss / 5:.5f} '
+                  f'{rates["samples_per_s"]:.1f} samples/s, input wait {rates["input_wait"]:.0%}')
             wandb.log({"loss": running_loss/5, 
                        "learning_rate": optimizer.param_groups[0]['lr'], 
-                       "steps": steps, "epoch": epoch+1})
+                       "steps": steps, "epoch": epoch+1, **rates})
             running_loss = 0.0
         elif i % 5 == 4:    # print every 100 mini-batches
-            print(f'\r[{epoch + 1}, {i + 1:5d}] loss: {running_loss / 5:.5f}', end="")
+            rates = throughput.report()
+            print(f'\r[{epoch + 1}, {i + 1:5d}] loss: {running_loss / 5:.5f} '
+                  f'{rates["samples_per_s"]:.1f} samples/s', end="")
             wandb.log({"loss": running_loss/5, 
                        "learning_rate": optimizer.param_groups[0]['lr'], 
-                       "steps": steps, "epoch": epoch+1})
+                       "steps": steps, "epoch": epoch+1, **rates})
             running_loss = 0.
         
                 
     #after training each epoch
+    updates += train_step.flush()
     print(f'\r[{epoch + 1}, {i + 1:5d}] loss: {total_loss / (i+1):.5f}')
     wandb.log({"total_loss": total_loss/(i+1), "steps":steps, "epoch": epoch+1})
     
@@ -142,19 +157,10 @@ for epoch in range(num_epochs):  # loop over the dataset multiple times
     with torch.no_grad():
         for data in valloader:
             # labels = data * scale
-            labels = data/(data.mean(axis=[1,2])+1e-16).unsqueeze(1).unsqueeze(2)
-            inputs = labels.sum(axis=1)
-            # labels = data/(data.mean(axis=[1,2])+1e-16).unsqueeze(1).unsqueeze(2)
-            # labels = apply_augmentation(labels)
-            # labels = torch.cat([separate_augmentation0(labels[:,0:1,:]),
-            #                     labels[:,1:2,:]], axis=1)
-            
-            labels = labels.to(device)
-            inputs = inputs.to(device).unsqueeze(1)
-            
-            outputs = model(inputs).squeeze(dim=2)
+            labels = prepare_batch(data, device, val_scale)
+            inputs = labels.sum(axis=1).unsqueeze(1)
             
-            val_loss = -criterion(outputs, labels)
+            val_loss = train_step.loss(inputs, labels)
             running_val_loss += val_loss.item()*inputs.shape[0]
             total += inputs.shape[0]
     
@@ -164,8 +170,6 @@ for epoch in range(num_epochs):  # loop over the dataset multiple times
                "steps": steps, "epoch": epoch+1})
         
     if running_val_loss <= best_val_loss:
-        torch.save(model, f'model{model_num}/best.pkl')
-        torch.save(optimizer, f'model{model_num}/best_optim.pkl')
         best_val_loss = running_val_loss
         
     if epoch in update_epochs:
@@ -173,8 +177,16 @@ for epoch in range(num_epochs):  # loop over the dataset multiple times
         scheduler.step()
         with open(f"model{model_num}.txt", "a") as file:
             file.write(f"Updating Learning Rate at epoch {epoch + 1} to {optimizer.param_groups[0]['lr']}\n")
-            
-torch.save(model, f'model{model_num}/final.pkl')
-torch.save(optimizer, f'model{model_num}/final_optim.pkl')
+
+    # The end of the epoch : the next one starts from this state
+    checkpoints.save(epoch + 1, {'model': model.state_dict(), 'optimizer': optimizer.state_dict(),
+                                 'scheduler': scheduler.state_dict(), 'scaler': train_step.scaler.state_dict(),
+                                 'loader': trainloader.generator.get_state(),
+                                 'epoch': epoch, 'steps': steps, 'updates': updates,
+                                 'best_val_loss': best_val_loss, 'rng': rng_state()},
+                     metric=running_val_loss / total)
+
+checkpoints.wait()
+torch.save(model.state_dict(), f'model{model_num}/final.pt')
 
 print('Finished Training')
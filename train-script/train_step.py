@@ -0,0 +1,69 @@
+# Optimization step of train.py : forward pass in mixed precision (autocast, with a
+# GradScaler on CUDA), gradients accumulated over several batches before each update,
+# and gradient clipping on the unscaled gradients.
+# On CPU, autocast runs in bfloat16 without scaler, so the same code can be tested
+# without a GPU.
+
+import contextlib
+import torch
+
+
+class TrainStep(object):
+    """Call with each batch; the optimizer is stepped every accumulation_steps batches
+
+    The effective batch size is accumulation_steps times the batch size of the loader.
+    """
+    def __init__(self, model, optimizer, criterion, device='cuda', amp=True, accumulation_steps=1,
+                 max_norm=5):
+        self.model = model
+        self.optimizer = optimizer
+        self.criterion = criterion
+        self.device_type = 'cuda' if str(device).startswith('cuda') else 'cpu'
+        self.amp = amp
+        self.amp_dtype = torch.float16 if self.device_type == 'cuda' else torch.bfloat16
+        self.accumulation_steps = accumulation_steps
+        self.max_norm = max_norm
+        # float16 gradients underflow without loss scaling, bfloat16 ones do not
+        self.scaler = torch.cuda.amp.GradScaler(enabled=amp and self.device_type == 'cuda')
+        self.pending = 0
+
+    def autocast(self):
+        if not self.amp:
+            return contextlib.nullcontext()
+        return torch.autocast(self.device_type, dtype=self.amp_dtype)
+
+    def loss(self, inputs, labels):
+        with self.autocast():
+            outputs = self.model(inputs).squeeze(dim=2)
+        # The permutation invariant SI-SNR is computed in float32
+        return -self.criterion(outputs.float(), labels)
+
+    def __call__(self, inputs, labels):
+        """Forward and backward pass of a batch, then the update if it completes an
+        accumulation; returns (loss, whether the optimizer was stepped)
+
+        """
+        loss = self.loss(inputs, labels)
+        self.scaler.scale(loss / self.accumulation_steps).backward()
+        self.pending += 1
+        if self.pending < self.accumulation_steps:
+            return loss.detach(), False
+        self.update()
+        return loss.detach(), True
+
+    def update(self):
+        # Clip the true gradients : unscale them first
+        self.scaler.unscale_(self.optimizer)
+        torch.nn.utils.clip_grad_norm_(self.model.parameters(), self.max_norm)
+        # Skipped by the scaler if the gradients overflowed
+        self.scaler.step(self.optimizer)
+        self.scaler.update()
+        self.optimizer.zero_grad(set_to_none=True)
+        self.pending = 0
+
+    def flush(self):
+        # Update with the gradients of an incomplete accumulation (end of an epoch)
+        if self.pending > 0:
+            self.update()
+            return True
+        return False